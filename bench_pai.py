@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks for pai.
+
+Usage: python bench_pai.py [BENCHMARK]...
+
+Benchmarks:
+
+  sort      numeric_file_sort on 1M synthetic page names
+  pageturn  ImageCache page-turn latency, with and without the forced
+            gc.collect() calls of pai 0.1.2, next to a 200k page FileList.
+            Needs the real PyGTK: the timings include pixbuf scaling, and
+            are meaningless with gtk stubbed out.
+
+"""
+from __future__ import division
+
+import sys, re, time, random, gc
+
+import pai
+
+def legacy_numeric_file_sort(filelist):
+    """numeric_file_sort as it was in pai 0.1.2"""
+    def sort_key(filename):
+        key = ""
+        lastend = 0
+        for match in re.finditer("\d+", filename):
+            key += filename[lastend:match.start()]
+            lastend = match.end()
+            key += "%08d" % (int(match.group()))
+        return key
+
+    lst = list(filelist)
+    lst.sort(key=sort_key)
+    return lst
+
+def timed(func, *a):
+    start = time.time()
+    func(*a)
+    return time.time() - start
+
+def bench_sort(count=1000000):
+    random.seed(1234)
+    names = ["/books/collection.cbz/vol%d/chapter %d/page_%04d.jpg"
+             % (j // 10000, (j // 100) % 100, j % 100)
+             for j in xrange(count)]
+    random.shuffle(names)
+
+    print "numeric_file_sort, %d names" % count
+    print "  legacy:  %6.2f s" % timed(legacy_numeric_file_sort, names)
+    print "  current: %6.2f s" % timed(pai.numeric_file_sort, names)
+
+    names = [name.replace("/books/collection.cbz/", "") for name in names]
+    print "sort keys, %d names" % count
+    print "  natural_sort_key:  %6.2f s" % timed(map, pai.natural_sort_key,
+                                                 names)
+    print "  natural_sort_keys: %6.2f s" % timed(pai.natural_sort_keys, names)
+
+def bench_pageturn(turns=200, pages=200000):
+    import gtk
+
+    filelist = pai.FileList([], scan=False)
+    filelist._files = ["/books/vol%d/page_%04d.jpg" % (j // 1000, j % 1000)
+                       for j in xrange(pages)]
+    # listing data kept by the unpackers: what a full collection walks
+    members = dict((filename, [j, 4096])
+                   for j, filename in enumerate(filelist._files))
+
+    raw = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, False, 8, 1200, 1700)
+    raw.fill(0x808080ff)
+    size = pai.pixbuf_size(raw)
+
+    def turn_pages(forced):
+        cache = pai.ImageCache(filelist, max_bytes=10*size, nthreads=1,
+                               disk_cache=False)
+        latencies = []
+        for j in xrange(turns):
+            filename = filelist[j]
+            start = time.time()
+            cache.add(filename, raw.copy())
+            if forced:
+                gc.collect() # on eviction
+            # not LOAD_VISIBLE: that gives an INTERP_NEAREST preview, and
+            # leaves the real scaling to the main loop
+            cache.get_scaled(filename, 600, 850,
+                             priority=pai.LOAD_SPECULATIVE)
+            if forced:
+                gc.collect() # after scaling
+            latencies.append(time.time() - start)
+        latencies.sort()
+        return latencies
+
+    print "page turns, %d pages in the file list" % pages
+    for label, forced in (("forced gc:", True), ("no gc:", False)):
+        lat = turn_pages(forced)
+        print "  %-11s median %6.1f ms, 95%% %6.1f ms, max %6.1f ms" % (
+            label, 1e3*lat[len(lat)//2], 1e3*lat[int(.95*len(lat))],
+            1e3*lat[-1])
+    del members
+
+BENCHMARKS = {
+    'sort': bench_sort,
+    'pageturn': bench_pageturn,
+    }
+
+def main():
+    names = sys.argv[1:] or sorted(BENCHMARKS.keys())
+    for name in names:
+        if name not in BENCHMARKS:
+            print >> sys.stderr, "Unknown benchmark: %s" % name
+            sys.exit(1)
+        BENCHMARKS[name]()
+
+if __name__ == "__main__": main()
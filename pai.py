@@ -16,7 +16,8 @@ __version__ = "0.1.2.dev"
 
 # Sorry, the code is slowly becoming a mess...
 
-import sys, os, shutil, tempfile, re, random, time, traceback, copy
+import sys, os, re, random, time, traceback, copy, itertools
+import signal
 import pygtk
 pygtk.require('2.0')
 import gtk
@@ -42,12 +43,34 @@ except ImportError:
 if HILDON:
     DEFAULT_COLUMNS = 1
     MAX_IMAGE_CACHE = 2
+    IMAGE_CACHE_BYTES = 24*1024*1024
+    WARM_CACHE_BYTES = 8*1024*1024
+    DISK_CACHE_BYTES = 32*1024*1024
+    MEMBER_CACHE_BYTES = 8*1024*1024
+    BYTE_PREFETCH_PAGES = 12
+    SCAN_THREADS = 2
+    DECODE_THREADS = 1
+    IDLE_GC = True
     DO_PRELOADING = True
 else:
     DEFAULT_COLUMNS = 2
     MAX_IMAGE_CACHE = 10
+    IMAGE_CACHE_BYTES = 192*1024*1024
+    WARM_CACHE_BYTES = 64*1024*1024
+    DISK_CACHE_BYTES = 256*1024*1024
+    MEMBER_CACHE_BYTES = 96*1024*1024
+    BYTE_PREFETCH_PAGES = 48
+    SCAN_THREADS = 6
+    DECODE_THREADS = 2
+    IDLE_GC = False
     DO_PRELOADING = True
 
+# JPEG quality of the screen-sized images cached on disk
+DISK_CACHE_QUALITY = 88
+
+# Milliseconds the reader stays on a page before jump targets are decoded
+JUMP_WARM_DELAY = 3000
+
 ##############################################################################
 ## GUI threading helpers
 ##############################################################################
@@ -120,6 +143,296 @@ def assert_gui_thread(func):
         return func(*a, **kw)
     return _wrapper
 
+##############################################################################
+## Background workers
+##############################################################################
+
+import heapq
+
+class Job(object):
+    """A function call queued in a `WorkerPool`"""
+
+    def __init__(self, priority, func, a, kw):
+        self.priority = priority
+        self.func = func
+        self.a = a
+        self.kw = kw
+        self.result = None
+        self.error = None
+        self.cancelled = False
+        self.started = False
+        self.done = threading.Event()
+
+    def cancel(self):
+        """Don't run the job, if it's not running already"""
+        self.cancelled = True
+
+    def wait(self):
+        """Wait for the job to finish, and return its result (or raise
+        its exception). Cancelled jobs return None."""
+        self.done.wait()
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.result
+
+class WorkerPool(object):
+    """
+    Pool of daemon worker threads, running jobs in priority order.
+
+    Jobs with the smallest `priority` run first; jobs with equal
+    priorities run in submission order.
+
+    >>> pool = WorkerPool(4)
+    >>> job = pool.submit(0, os.listdir, "/")
+    >>> files = job.wait()
+
+    """
+
+    def __init__(self, nthreads):
+        self.cond = threading.Condition()
+        self.queue = []
+        self.counter = 0
+        self.closed = False
+        for j in range(nthreads):
+            thread = threading.Thread(target=self.__run)
+            thread.setDaemon(True)
+            thread.start()
+
+    def submit(self, priority, func, *a, **kw):
+        """Queue ``func(*a, **kw)`` to be run, and return its Job"""
+        job = Job(priority, func, a, kw)
+        self.cond.acquire()
+        try:
+            self.counter += 1
+            heapq.heappush(self.queue, (priority, self.counter, job))
+            self.cond.notify()
+        finally:
+            self.cond.release()
+        return job
+
+    def close(self):
+        """Stop the worker threads after the queued jobs are done"""
+        self.cond.acquire()
+        try:
+            self.closed = True
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def __run(self):
+        while True:
+            self.cond.acquire()
+            try:
+                while not self.queue and not self.closed:
+                    self.cond.wait()
+                if not self.queue:
+                    return
+                priority, counter, job = heapq.heappop(self.queue)
+            finally:
+                self.cond.release()
+
+            if not job.cancelled:
+                job.started = True
+                try:
+                    job.result = job.func(*job.a, **job.kw)
+                except:
+                    job.error = sys.exc_info()
+            job.done.set()
+            del job
+
+##############################################################################
+## Statistics
+##############################################################################
+
+class Counters(object):
+    """
+    Named event counters, for tuning the caches. Thread-safe.
+
+    >>> STATS.add('bytes.hit')
+    >>> STATS.add('bytes.read', 4096)
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def add(self, name, value=1):
+        self.lock.acquire()
+        try:
+            self.counts[name] = self.counts.get(name, 0) + value
+        finally:
+            self.lock.release()
+
+    def get(self, name):
+        return self.counts.get(name, 0)
+
+    def report(self, f=None):
+        """Print the counters, grouped by prefix"""
+        if f is None:
+            f = sys.stderr
+        self.lock.acquire()
+        try:
+            items = sorted(self.counts.items())
+        finally:
+            self.lock.release()
+        for name, value in items:
+            if isinstance(value, float):
+                print >> f, "%-28s %12.3f" % (name, value)
+            else:
+                print >> f, "%-28s %12d" % (name, value)
+
+STATS = Counters()
+
+##############################################################################
+## Caches
+##############################################################################
+
+class LRUCache(object):
+    """
+    Least-recently-used cache with a size budget. Thread-safe.
+
+    Each item is charged ``sizeof(value)`` against `max_size`, and adding
+    items evicts the least recently used ones until the total fits.
+    Lookup, promotion and eviction are O(1).
+    """
+
+    # link layout: [prev, next, key, value, size]
+    PREV, NEXT, KEY, VALUE, SIZE = range(5)
+
+    def __init__(self, max_size, sizeof=len):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self.lock = threading.RLock()
+        self.map = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None, 0]
+
+    def __len__(self):
+        return len(self.map)
+
+    def __contains__(self, key):
+        return key in self.map
+
+    def get(self, key, default=None):
+        """Return the cached value, and mark it most recently used."""
+        self.lock.acquire()
+        try:
+            link = self.map.get(key)
+            if link is None:
+                return default
+            self.__unlink(link)
+            self.__append(link)
+            return link[LRUCache.VALUE]
+        finally:
+            self.lock.release()
+
+    def put(self, key, value):
+        """Add a value, evicting old items if over budget."""
+        size = self.sizeof(value)
+        self.lock.acquire()
+        try:
+            self.pop(key)
+            if size > self.max_size:
+                return
+            link = [None, None, key, value, size]
+            self.__append(link)
+            self.map[key] = link
+            self.size += size
+            while self.size > self.max_size:
+                self.pop(self.root[LRUCache.NEXT][LRUCache.KEY])
+        finally:
+            self.lock.release()
+
+    def pop(self, key, default=None):
+        """Remove an item from the cache, and return its value."""
+        self.lock.acquire()
+        try:
+            link = self.map.pop(key, None)
+            if link is None:
+                return default
+            self.__unlink(link)
+            self.size -= link[LRUCache.SIZE]
+            return link[LRUCache.VALUE]
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.map.clear()
+            self.root[:] = [self.root, self.root, None, None, 0]
+            self.size = 0
+        finally:
+            self.lock.release()
+
+    def __unlink(self, link):
+        prev, next = link[LRUCache.PREV], link[LRUCache.NEXT]
+        prev[LRUCache.NEXT] = next
+        next[LRUCache.PREV] = prev
+
+    def __append(self, link):
+        last = self.root[LRUCache.PREV]
+        link[LRUCache.PREV] = last
+        link[LRUCache.NEXT] = self.root
+        last[LRUCache.NEXT] = link
+        self.root[LRUCache.PREV] = link
+
+# Compressed image data (archive members and files on disk) read ahead of
+# time, keyed by full file name
+MEMBER_CACHE = LRUCache(MEMBER_CACHE_BYTES)
+
+import cPickle as pickle
+import hashlib
+
+def state_path(*parts):
+    """Return a path under the pai state directory ~/.pai, creating the
+    parent directories as needed."""
+    path = os.path.join(os.path.expanduser("~"), ".pai", *parts)
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    return path
+
+def file_identity(path):
+    """Return (realpath, size, mtime_ns) identifying the contents of a file"""
+    st = os.stat(path)
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1e9)
+    return (os.path.realpath(path), st.st_size, mtime_ns)
+
+def load_state(kind, identity):
+    """Load data stored with `save_state` for the given file identity.
+    Returns None if there is none, or if it is stale."""
+    key = hashlib.md5(repr(identity[0])).hexdigest()
+    try:
+        f = open(state_path(kind, key), 'rb')
+        try:
+            stored_identity, data = pickle.load(f)
+        finally:
+            f.close()
+    except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError):
+        return None
+    if stored_identity != identity:
+        return None
+    return data
+
+def save_state(kind, identity, data):
+    """Store data associated with the given file identity on disk."""
+    key = hashlib.md5(repr(identity[0])).hexdigest()
+    try:
+        filename = state_path(kind, key)
+        f = open(filename + '.new', 'wb')
+        try:
+            pickle.dump((identity, data), f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(filename + '.new', filename)
+    except (IOError, OSError):
+        pass
+
 ##############################################################################
 ## Image list / recursive archive unpack
 ##############################################################################
@@ -127,54 +440,386 @@ def assert_gui_thread(func):
 import zipfile
 import tarfile
 import subprocess
+import zlib, bz2, binascii, bisect
+import stat, struct
+import cStringIO as StringIO
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+MAX_OPEN_ARCHIVES = 8
+
+class HandlePool(object):
+    """
+    Bounded pool of open archive handles, shared by all unpackers.
+
+    Opening an archive (eg. parsing the central directory of a zip file)
+    can be expensive, so the handles are kept open and reused. Handles
+    not in use are closed in least-recently-used order when the pool
+    grows over `max_handles`.
+
+    A handle is used by one thread at a time:
+
+    >>> handle = pool.acquire(key, opener)
+    >>> try:
+    ...     data = handle.read(name)
+    ... finally:
+    ...     pool.release(key)
+
+    """
+
+    class _Entry(object):
+        def __init__(self):
+            self.handle = None
+            self.users = 0
+            self.lock = threading.Lock()
+
+    def __init__(self, max_handles=MAX_OPEN_ARCHIVES):
+        self.max_handles = max_handles
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.lru = [] # least recently used first
+
+    def acquire(self, key, opener):
+        """Get exclusive use of the handle for `key`, opening it via
+        ``opener()`` if it is not open yet."""
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = HandlePool._Entry()
+                self.entries[key] = entry
+            else:
+                self.lru.remove(key)
+            self.lru.append(key)
+            entry.users += 1
+        finally:
+            self.lock.release()
+
+        entry.lock.acquire()
+        if entry.handle is None:
+            try:
+                entry.handle = opener()
+            except:
+                entry.lock.release()
+                self.__drop_user(key, entry, discard=True)
+                raise
+        return entry.handle
+
+    def release(self, key):
+        """Give back a handle obtained with `acquire`."""
+        entry = self.entries[key]
+        entry.lock.release()
+        self.__drop_user(key, entry)
+
+    def close(self, key=None):
+        """Close the handle for `key`, or all idle handles."""
+        self.lock.acquire()
+        try:
+            if key is None:
+                keys = list(self.lru)
+            else:
+                keys = [key]
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is not None and entry.users == 0:
+                    self.__remove(key)
+        finally:
+            self.lock.release()
+
+    def __drop_user(self, key, entry, discard=False):
+        self.lock.acquire()
+        try:
+            entry.users -= 1
+            if discard and entry.users == 0 and entry.handle is None:
+                self.__remove(key)
+            # close idle handles, least recently used first
+            idle = [k for k in self.lru if self.entries[k].users == 0]
+            while len(self.lru) > self.max_handles and idle:
+                self.__remove(idle.pop(0))
+        finally:
+            self.lock.release()
+
+    def __remove(self, key):
+        entry = self.entries.pop(key)
+        self.lru.remove(key)
+        if entry.handle is not None:
+            try:
+                entry.handle.close()
+            except (IOError, OSError):
+                pass
+
+ARCHIVE_HANDLES = HandlePool()
+
+# Handles of archives nested in other archives. Each may hold a memory
+# buffer of up to NESTED_MEMORY_LIMIT, so only a few are kept open.
+NESTED_HANDLES = HandlePool(2)
 
 class ExtensionMap(dict):
+    """
+    Dictionary keyed by file name extensions (eg. '.tar.gz'), looked up
+    with full file names.
+
+    Keys are lowercase and start with a dot. A lookup probes the suffixes
+    of the name starting at its last few dots, and the longest one present
+    wins. This is a few dict probes, regardless of the number of keys.
+    """
+
     def __init__(self, dictionary=None):
         dict.__init__(self)
-        self.update(dictionary)
-        
+        self.ndots = 0
+        if dictionary:
+            self.update(dictionary)
+
+    def __setitem__(self, key, value):
+        key = key.lower()
+        if not key.startswith('.'):
+            raise ValueError("Extension %r does not start with a dot" % key)
+        self.ndots = max(self.ndots, key.count('.'))
+        dict.__setitem__(self, key, value)
+
+    def update(self, dictionary):
+        for key, value in dictionary.items():
+            self[key] = value
+
+    def match(self, string):
+        """Return the longest key that is a suffix of string, or None"""
+        found = None
+        pos = len(string)
+        for j in xrange(self.ndots):
+            pos = string.rfind('.', 0, pos)
+            if pos < 0:
+                break
+            suffix = string[pos:].lower()
+            if dict.__contains__(self, suffix):
+                found = suffix
+        return found
+
     def has_key(self, string):
-        for key in self.iterkeys():
-            if string.lower().endswith(key):
-                return True
-        return False
+        return self.match(string) is not None
 
     def get(self, string, default=None):
-        for key in self.iterkeys():
-            if string.lower().endswith(key):
-                return dict.__getitem__(self, key)
-        return default
+        key = self.match(string)
+        if key is None:
+            return default
+        return dict.__getitem__(self, key)
 
     def __contains__(self, string):
-        return self.has_key(string)
+        return self.match(string) is not None
 
     def __getitem__(self, string):
-        for key in self.iterkeys():
-            if string.lower().endswith(key):
-                return dict.__getitem__(self, key)
-        raise KeyError(string)
+        key = self.match(string)
+        if key is None:
+            raise KeyError(string)
+        return dict.__getitem__(self, key)
+
+NUMBER_RE = re.compile(r"(\d+)")
+
+class _NumberKeys(dict):
+    """Sort keys for digit strings, computed on demand and cached.
+
+    The key is '0', the length of the number without leading zeroes
+    (itself prefixed by its length), and the digits. Keys of numbers
+    compare as the values, and a number sorts where a '0' character
+    would."""
+
+    def __missing__(self, digits):
+        if len(self) > 100000:
+            self.clear()
+        value = digits.lstrip("0")
+        length = str(len(value))
+        key = "0%d%s%s" % (len(length), length, value)
+        self[digits] = key
+        return key
+
+NUMBER_KEYS = _NumberKeys()
+
+def natural_sort_key(filename):
+    """Return a sort key for the file name, comparing numbers by value."""
+    parts = NUMBER_RE.split(filename)
+    parts[1::2] = [NUMBER_KEYS[digits] for digits in parts[1::2]]
+    return "".join(parts)
+
+def natural_sort_keys(filenames):
+    """Return natural_sort_key for each of the file names."""
+    # The regexp and the number keys are applied to all names in one go,
+    # which is much faster than doing it name by name
+    joined = "\0".join(filenames)
+    parts = NUMBER_RE.split(joined)
+    parts[1::2] = [NUMBER_KEYS[digits] for digits in parts[1::2]]
+    keys = "".join(parts).split("\0")
+    if len(keys) != len(filenames):
+        # NUL characters in the names
+        keys = map(natural_sort_key, filenames)
+    return keys
 
 def numeric_file_sort(filelist):
     """Return the given list, sorted by file name, not heeding
        leading zeroes in numbers."""
-    
-    def sort_key(filename):
-        key = ""
-        lastend = 0
-        for match in re.finditer("\d+", filename):
-            key += filename[lastend:match.start()]
-            lastend = match.end()
-            key += "%08d" % (int(match.group()))
-        return key
-
     lst = list(filelist)
-    lst.sort(key=sort_key)
-    return lst
+    if len(lst) < 2:
+        return lst
+
+    # Directory part shared by all is irrelevant for the order
+    prefix = os.path.commonprefix([min(lst), max(lst)])
+    skip = prefix.rfind(os.path.sep) + 1
+    if skip > 0:
+        keys = natural_sort_keys([filename[skip:] for filename in lst])
+    else:
+        keys = natural_sort_keys(lst)
+
+    order = range(len(lst))
+    order.sort(key=keys.__getitem__)
+    return [lst[j] for j in order]
+
+def read_command_output(args):
+    """Run an external (un)packer and return what it wrote to stdout.
+
+    The member data is read straight from the pipe into memory, so that
+    nothing is written to disk."""
+    try:
+        p = subprocess.Popen(args, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, stdin=subprocess.PIPE)
+    except OSError, e:
+        raise IOError("Failed to run %s: %s" % (args[0], e))
+    out, err = p.communicate()
+    if p.returncode != 0 or not out:
+        raise IOError("%s failed (%s): %s" % (args[0], p.returncode,
+                                               err.strip()))
+    return out
+
+NESTED_MEMORY_LIMIT = 32*1024*1024
+MAX_NESTING = 4
+
+class FileSlice(object):
+    """Read-only file object for a byte range of a file"""
+
+    def __init__(self, filename, offset, size):
+        self.f = open(filename, 'rb')
+        self.offset = offset
+        self.size = size
+        self.pos = 0
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self.pos
+        elif whence == 2:
+            pos += self.size
+        self.pos = min(max(pos, 0), self.size)
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        if size < 0 or size > self.size - self.pos:
+            size = self.size - self.pos
+        self.f.seek(self.offset + self.pos)
+        data = self.f.read(size)
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+# Kernel readahead hints
+READAHEAD_HINTS = True
+POSIX_FADV_WILLNEED = getattr(os, 'POSIX_FADV_WILLNEED', 3) # 3 on Linux
+
+_FADVISE = []
+
+def get_fadvise():
+    """Return a ``posix_fadvise(fd, offset, length, advice)`` function,
+    from the os module or the C library, or None if there is none."""
+    if _FADVISE:
+        return _FADVISE[0]
+    fadvise = getattr(os, 'posix_fadvise', None)
+    if fadvise is None:
+        try:
+            import ctypes, ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6')
+            func = getattr(libc, 'posix_fadvise64', None)
+            if func is None:
+                func = libc.posix_fadvise
+            func.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64,
+                             ctypes.c_int]
+            func.restype = ctypes.c_int
+            def fadvise(fd, offset, length, advice):
+                err = func(fd, offset, length, advice)
+                if err != 0:
+                    raise OSError(err, os.strerror(err))
+        except (ImportError, OSError, AttributeError):
+            fadvise = None
+    _FADVISE.append(fadvise)
+    return fadvise
+
+def advise_willneed(path, offset=0, length=0):
+    """
+    Ask the kernel to start reading a byte range of a file to the page
+    cache; length 0 means up to the end. Returns True if the hint was
+    given.
+    """
+    fadvise = get_fadvise()
+    if fadvise is None:
+        STATS.add('readahead.unsupported')
+        return False
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            if length == 0:
+                length = max(os.fstat(fd).st_size - offset, 0)
+            fadvise(fd, offset, length, POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+    except OSError:
+        STATS.add('readahead.errors')
+        return False
+    STATS.add('readahead.hints')
+    STATS.add('readahead.bytes', length)
+    return True
+
+def read_ahead(name, opener):
+    """Read a file to the member cache, unless it's there already"""
+    if name in MEMBER_CACHE:
+        return
+    try:
+        fh = opener()
+        if isinstance(fh, str):
+            data = fh
+        else:
+            try:
+                data = fh.read()
+            finally:
+                fh.close()
+    except (IOError, OSError):
+        return
+    MEMBER_CACHE.put(name, data)
+    STATS.add('bytes.prefetched', len(data))
 
 class DummyUnpacker(object):
-    def __init__(self, archive_filename):
+    # can read archives nested inside other archives
+    nestable = False
+
+    def __init__(self, archive_filename, opener=None, identity=None):
+        """
+        Parameters
+        ----------
+        archive_filename
+            Name of the archive.
+        opener
+            Function returning the archive as a seekable file object, if
+            it is not a file on disk (eg. nested in another archive).
+        identity
+            Identity of the archive contents, see `file_identity`.
+        """
         self.archive = archive_filename
         self._files = None
+        self._opener = opener
+        self._identity = identity
 
     @property
     def files(self):
@@ -186,10 +831,79 @@ class DummyUnpacker(object):
     def _get_files(self):
         return [self.archive]
 
+    def get_listing(self):
+        """Return the archive listing as plain data, for caching"""
+        return [self._unprefix_archive(fn) for fn in self.files]
+
+    def set_listing(self, listing):
+        """Restore a listing obtained from `get_listing`"""
+        self._files = self._prefix_archive(listing)
+
     def open_file(self, name):
         """Open a file in the archive"""
         return open(self.archive, 'r')
 
+    def prefetch(self, names):
+        """Read the given files to the member cache, to open them soon"""
+        for name in names:
+            read_ahead(name, lambda name=name: self.open_file(name))
+
+    def get_identity(self):
+        """Return (name, size, mtime_ns) identifying the archive contents"""
+        if self._identity is None:
+            self._identity = file_identity(self.archive)
+        return self._identity
+
+    def open_nested(self, name, unpacker_class):
+        """Return an unpacker for an archive inside this archive, or None
+        if it cannot be read without extracting it to disk."""
+        if not unpacker_class.nestable:
+            return None
+        opener = self._member_opener(name)
+        if opener is None:
+            return None
+        identity = self.get_identity()
+        identity = ((identity[0] + os.path.sep
+                     + self._unprefix_archive(name),) + tuple(identity[1:]))
+        return unpacker_class(name, opener=opener, identity=identity)
+
+    def _handles(self):
+        """Return the pool for the open handles of this archive"""
+        if self._opener is not None:
+            return NESTED_HANDLES
+        return ARCHIVE_HANDLES
+
+    def _open_archive(self):
+        """Open the archive itself, as a seekable file object"""
+        if self._opener is not None:
+            return self._opener()
+        return open(self.archive, 'rb')
+
+    def _member_size(self, name):
+        """Return the uncompressed size of a member, or None if unknown"""
+        return None
+
+    def _member_range(self, name):
+        """Return (path, offset, length) of the bytes of a member on disk,
+        for readahead hints, or None if not known"""
+        return None
+
+    def _member_opener(self, name):
+        """Return a function opening a member as a seekable file object.
+        By default, small members are read to memory."""
+        size = self._member_size(name)
+        if size is None or size > NESTED_MEMORY_LIMIT:
+            return None
+        def opener():
+            data = self.open_file(name)
+            if not isinstance(data, str):
+                try:
+                    data = data.read()
+                finally:
+                    data.close()
+            return StringIO.StringIO(data)
+        return opener
+
     def _prefix_archive(self, lst):
         return [self.archive + os.path.sep + fn for fn in lst]
 
@@ -198,121 +912,943 @@ class DummyUnpacker(object):
             raise ValueError("File not in archive!")
         return name[len(self.archive)+1:]
     
+# Slack for differences between the local and central zip extra fields
+ZIP_EXTRA_PAD = 1024
+
 class ZipUnpacker(DummyUnpacker):
+    nestable = True
+
+    def _open_zip(self):
+        if self._opener is None:
+            return zipfile.ZipFile(self.archive, 'r')
+        return zipfile.ZipFile(self._opener(), 'r')
+
+    def _get_info(self, name):
+        handles = self._handles()
+        f = handles.acquire(self.archive, self._open_zip)
+        try:
+            return f.getinfo(self._unprefix_archive(name))
+        finally:
+            handles.release(self.archive)
+
+    def _member_size(self, name):
+        return self._get_info(name).file_size
+
+    def _member_range(self, name):
+        if self._opener is not None:
+            return None
+        info = self._get_info(name)
+        filename = info.filename
+        if isinstance(filename, unicode):
+            filename = filename.encode('utf-8')
+        # local header + name + extra field + data. The local extra field
+        # need not match the one in the central directory; pad for it,
+        # rather than reading the local header here
+        return (self.archive, info.header_offset,
+                30 + len(filename) + len(info.extra) + ZIP_EXTRA_PAD
+                + info.compress_size)
+
+    def _member_opener(self, name):
+        info = self._get_info(name)
+        if self._opener is not None or info.compress_type != zipfile.ZIP_STORED:
+            return DummyUnpacker._member_opener(self, name)
+
+        # Stored members of zip files on disk are read in place
+        f = open(self.archive, 'rb')
+        try:
+            f.seek(info.header_offset)
+            header = f.read(30)
+        finally:
+            f.close()
+        if len(header) != 30 or header[:4] != 'PK\x03\x04':
+            return None
+        name_size, extra_size = struct.unpack('<HH', header[26:30])
+        offset = info.header_offset + 30 + name_size + extra_size
+        def opener():
+            return FileSlice(self.archive, offset, info.file_size)
+        return opener
+
     def _get_files(self):
-        f = zipfile.ZipFile(self.archive, 'r')
+        handles = self._handles()
+        f = handles.acquire(self.archive, self._open_zip)
         try:
             return self._prefix_archive(f.namelist())
         finally:
-            f.close()
+            handles.release(self.archive)
 
     def open_file(self, name):
         name = self._unprefix_archive(name)
-        f = zipfile.ZipFile(self.archive, 'r')
+        handles = self._handles()
+        f = handles.acquire(self.archive, self._open_zip)
         try:
             return f.read(name)
         finally:
-            f.close()
+            handles.release(self.archive)
+
+class ChunkReader(object):
+    """File-like object reading from an iterator of strings"""
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = ""
+
+    def read(self, size=-1):
+        parts = [self.buf]
+        got = len(self.buf)
+        while size < 0 or got < size:
+            try:
+                chunk = self.chunks.next()
+            except StopIteration:
+                break
+            parts.append(chunk)
+            got += len(chunk)
+        data = "".join(parts)
+        if size < 0:
+            self.buf = ""
+            return data
+        self.buf = data[size:]
+        return data[:size]
+
+TAR_CHECKPOINT_SPACING = 4*1024*1024
+TAR_READ_SIZE = 64*1024
+
+BZ2_BLOCK_MAGIC = 0x314159265359L
+BZ2_EOS_MAGIC = 0x177245385090L
+
+def find_bit_pattern(data, pattern, nbits):
+    """Return the bit offsets where the `nbits` long bit string `pattern`
+    occurs in data."""
+    found = []
+    for shift in range(8):
+        total = shift + nbits
+        nbytes = (total + 7) // 8
+        pad = nbytes*8 - total
+        full = binascii.unhexlify('%0*x' % (nbytes*2, pattern << pad))
+        first_mask = 0xff >> shift
+        last_mask = (0xff << pad) & 0xff
+
+        # search for the whole bytes, then check the partial ones
+        lo = int(shift > 0)
+        hi = nbytes - int(pad > 0)
+        pos = data.find(full[lo:hi], lo)
+        while pos >= 0:
+            start = pos - lo
+            ok = True
+            if lo:
+                ok = ord(data[start]) & first_mask == ord(full[0])
+            if ok and pad:
+                ok = (start + nbytes <= len(data) and
+                      ord(data[start+nbytes-1]) & last_mask == ord(full[-1]))
+            if ok:
+                found.append(start*8 + shift)
+            pos = data.find(full[lo:hi], pos + 1)
+    found.sort()
+    return found
+
+def read_bits(fileobj, start, end):
+    """Return bits [start, end) of a file, as an integer"""
+    fileobj.seek(start // 8)
+    data = fileobj.read((end + 7) // 8 - start // 8)
+    if not data:
+        return 0L
+    value = long(binascii.hexlify(data), 16)
+    value >>= len(data)*8 - (end - start // 8 * 8)
+    return value & ((1L << (end - start)) - 1)
+
+def bz2_block_stream(bits, nbits):
+    """Make a stand-alone bzip2 stream out of a single compressed block"""
+    crc = (bits >> (nbits - 80)) & 0xffffffffL
+    value = (((bits << 48) | BZ2_EOS_MAGIC) << 32) | crc
+    nbits += 80
+    pad = -nbits % 8
+    return 'BZh9' + binascii.unhexlify('%0*x' % ((nbits + pad)//4,
+                                                  value << pad))
+
+class TarIndex(object):
+    """
+    Member offset index of a tar archive, for random access.
+
+    Compressed archives are read starting from the nearest checkpoint
+    before the member. For bzip2, the checkpoints are the boundaries of
+    the compressed blocks: each block can be decompressed on its own.
+    They are found once and stored in the index state.
+
+    For gzip, the checkpoints are copies of the decompressor state, as
+    in zlib's ``zran.c``. Python's zlib cannot restore a decompressor
+    from its window, so these are only kept in memory; they are taken
+    every `TAR_CHECKPOINT_SPACING` bytes when the archive is read.
+    """
+
+    def __init__(self, fileobj, state=None):
+        self.checkpoints = []
+        self.checkpoint_offsets = []
+        if state is not None:
+            self.compression, self.names, self.members, self.blocks = state
+        else:
+            self.__scan(fileobj)
+
+    def get_state(self):
+        """Return the index as plain data, for storing"""
+        return (self.compression, self.names, self.members, self.blocks)
+
+    def compressed_range(self, name):
+        """Return (offset, length) of the archive bytes holding a member,
+        or None if not known"""
+        offset, size = self.members[name]
+        if self.compression is None:
+            return offset, size
+        elif self.compression == 'bz2' and self.blocks:
+            starts = [b[2] for b in self.blocks]
+            j = max(bisect.bisect_right(starts, offset) - 1, 0)
+            k = max(bisect.bisect_left(starts, offset + size) - 1, j)
+            start = self.blocks[j][0] // 8
+            end = (self.blocks[k][1] + 7) // 8
+            return start, end - start
+        return None
+
+    def read(self, fileobj, name):
+        """Read the contents of a member"""
+        offset, size = self.members[name]
+        if size == 0:
+            return ""
+        elif self.compression is None:
+            fileobj.seek(offset)
+            return fileobj.read(size)
+        elif self.compression == 'other':
+            f = tarfile.open(fileobj=fileobj, mode='r:*')
+            return f.extractfile(name).read()
+        elif self.compression == 'gz':
+            j = bisect.bisect_right(self.checkpoint_offsets, offset) - 1
+            if j >= 0:
+                checkpoint = self.checkpoints[j]
+                pos = checkpoint[0]
+            else:
+                checkpoint = None
+                pos = 0
+            chunks = self.__inflate(fileobj, checkpoint)
+        elif self.compression == 'bz2':
+            j = bisect.bisect_right([b[2] for b in self.blocks], offset) - 1
+            j = max(j, 0)
+            chunks = self.__bunzip(fileobj, self.blocks[j:])
+            pos = self.blocks[j][2]
+
+        # skip to the member, and read it
+        parts = []
+        got = 0
+        for chunk in chunks:
+            if pos + len(chunk) > offset:
+                part = chunk[max(offset - pos, 0):]
+                parts.append(part)
+                got += len(part)
+                if got >= size:
+                    break
+            pos += len(chunk)
+        return "".join(parts)[:size]
+
+    def __scan(self, fileobj):
+        fileobj.seek(0)
+        magic = fileobj.read(3)
+        fileobj.seek(0)
+        if magic[:2] == '\x1f\x8b':
+            self.compression = 'gz'
+            self.blocks = []
+            self.__list(ChunkReader(self.__inflate(fileobj, None)), 'r|')
+        elif magic == 'BZh':
+            self.compression = 'bz2'
+            self.blocks = []
+            self.__list(ChunkReader(self.__bz2_scan(fileobj)), 'r|')
+        else:
+            self.compression = None
+            self.blocks = []
+            try:
+                self.__list(fileobj, 'r:')
+            except tarfile.ReadError:
+                # some other compression; no random access
+                fileobj.seek(0)
+                self.compression = 'other'
+                self.__list(fileobj, 'r:*')
+
+    def __list(self, fileobj, mode):
+        self.names = []
+        self.members = {}
+        f = tarfile.open(fileobj=fileobj, mode=mode)
+        for info in f:
+            if info.isfile():
+                self.names.append(info.name)
+                self.members[info.name] = (info.offset_data, info.size)
+
+    def __inflate(self, fileobj, checkpoint):
+        """Decompress gzip data from the checkpoint onwards, taking new
+        checkpoints on the way."""
+        if checkpoint is None:
+            upos, cpos = 0, 0
+            d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            upos, cpos, d = checkpoint
+            d = d.copy()
+        next_checkpoint = upos + TAR_CHECKPOINT_SPACING
+        fileobj.seek(cpos)
+        while True:
+            chunk = fileobj.read(TAR_READ_SIZE)
+            if not chunk:
+                break
+            cpos += len(chunk)
+            data = d.decompress(chunk)
+            while d.unused_data:
+                # concatenated gzip streams
+                chunk = d.unused_data
+                d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                data += d.decompress(chunk)
+            upos += len(data)
+            if upos >= next_checkpoint:
+                self.__add_checkpoint(upos, cpos, d)
+                next_checkpoint = upos + TAR_CHECKPOINT_SPACING
+            yield data
+
+    def __add_checkpoint(self, upos, cpos, d):
+        j = bisect.bisect_left(self.checkpoint_offsets, upos)
+        for k in j - 1, j:
+            if 0 <= k < len(self.checkpoint_offsets) and \
+                   abs(self.checkpoint_offsets[k] - upos) \
+                   < TAR_CHECKPOINT_SPACING // 2:
+                return
+        self.checkpoint_offsets.insert(j, upos)
+        self.checkpoints.insert(j, (upos, cpos, d.copy()))
+
+    def __bunzip(self, fileobj, blocks):
+        for start, end, upos, usize in blocks:
+            yield bz2.decompress(bz2_block_stream(
+                read_bits(fileobj, start, end), end - start))
+
+    def __bz2_scan(self, fileobj):
+        """Find the bzip2 block boundaries, and decompress the blocks."""
+        # Find candidate block boundaries
+        bounds = set()
+        overlap = 8
+        base = 0
+        while True:
+            fileobj.seek(base)
+            data = fileobj.read(16*TAR_READ_SIZE + overlap)
+            for pattern, kind in ((BZ2_BLOCK_MAGIC, 0), (BZ2_EOS_MAGIC, 1)):
+                for bit in find_bit_pattern(data, pattern, 48):
+                    bounds.add((base*8 + bit, kind))
+            if len(data) <= overlap:
+                break
+            base += len(data) - overlap
+        bounds = sorted(bounds)
+
+        # Decompress; the magic numbers can appear by chance also inside
+        # compressed data, so skip boundaries that don't work out
+        upos = 0
+        i = 0
+        while i < len(bounds):
+            start, kind = bounds[i]
+            if kind != 0:
+                i += 1
+                continue
+            for j in xrange(i + 1, len(bounds)):
+                end = bounds[j][0]
+                try:
+                    data = bz2.decompress(bz2_block_stream(
+                        read_bits(fileobj, start, end), end - start))
+                except (IOError, ValueError, EOFError):
+                    continue
+                break
+            else:
+                raise IOError("Corrupted bzip2 data")
+            self.blocks.append((start, end, upos, len(data)))
+            upos += len(data)
+            i = j
+            yield data
 
 class TarUnpacker(DummyUnpacker):
+    nestable = True
+
+    def __init__(self, *a, **kw):
+        DummyUnpacker.__init__(self, *a, **kw)
+        self._index = None
+
+    def _open_tar(self):
+        return self._open_archive()
+
+    def _member_size(self, name):
+        return self._get_index().members[self._unprefix_archive(name)][1]
+
+    def _member_range(self, name):
+        if self._opener is not None:
+            return None
+        byte_range = self._get_index().compressed_range(
+            self._unprefix_archive(name))
+        if byte_range is None:
+            return None
+        return (self.archive,) + byte_range
+
+    def _member_opener(self, name):
+        index = self._get_index()
+        if self._opener is not None or index.compression is not None:
+            return DummyUnpacker._member_opener(self, name)
+
+        # Members of uncompressed tar files on disk are read in place
+        offset, size = index.members[self._unprefix_archive(name)]
+        def opener():
+            return FileSlice(self.archive, offset, size)
+        return opener
+
+    def _get_index(self):
+        if self._index is None:
+            identity = self.get_identity()
+            state = load_state('tarindex', identity)
+            handles = self._handles()
+            f = handles.acquire(self.archive, self._open_tar)
+            try:
+                self._index = TarIndex(f, state)
+            finally:
+                handles.release(self.archive)
+            if state is None:
+                save_state('tarindex', identity, self._index.get_state())
+        return self._index
+
     def _get_files(self):
-        f = tarfile.open(self.archive_filename, 'r')
-        try:
-            return self._prefix_archive(f.getnames())
-        finally:
-            f.close()
+        return self._prefix_archive(self._get_index().names)
 
     def open_file(self, name):
         name = self._unprefix_archive(name)
-        f = tarfile.open(self.archive_filename, 'r')
+        index = self._get_index()
+        handles = self._handles()
+        f = handles.acquire(self.archive, self._open_tar)
         try:
-            return f.extractfile(name).read()
-        except:
-            f.close()
+            return index.read(f, name)
+        finally:
+            handles.release(self.archive)
+
+class CommandUnpacker(DummyUnpacker):
+    """
+    Archive unpacked by running an external program.
+
+    Each program run re-reads the archive headers, so members can be
+    extracted in batches with `prefetch`: the program writes the members
+    back-to-back to stdout in archive order, and the stream is split
+    using the member sizes from the archive listing.
+
+    In solid archives, extracting a member means decompressing all
+    members before it. For those, a single `SolidStream` runs through
+    the archive sequentially and feeds the member cache.
+    """
+
+    def __init__(self, *a, **kw):
+        DummyUnpacker.__init__(self, *a, **kw)
+        self._members = []
+        self._sizes = {}
+        self._order = {}
+        self._pending = {}
+        self._solid = False
+        self._stream = None
+        self._lock = threading.Lock()
+
+    def _list_members(self):
+        """Return ([(name, size), ...], solid) for files in the archive, in
+        archive order. Size is None if not known."""
+        raise NotImplementedError
+
+    def _extract_command(self, names):
+        """Return the command writing given members to stdout"""
+        raise NotImplementedError
+
+    def _member_size(self, name):
+        self.files
+        return self._sizes.get(self._unprefix_archive(name))
 
-class RarUnpacker(DummyUnpacker):
     def _get_files(self):
-        p = subprocess.Popen(["unrar", "vb", self.archive],
-                             stdout=subprocess.PIPE,
-                             stdin=subprocess.PIPE)
-        out, err = p.communicate()
-        lst = [fn.strip() for fn in out.split("\n") if fn.strip()]
-        return self._prefix_archive(lst)
-    
+        members, solid = self._list_members()
+        self.set_listing((members, solid))
+        return self._files
+
+    def get_listing(self):
+        self.files
+        return (self._members, self._solid)
+
+    def set_listing(self, listing):
+        members, solid = listing
+        for j, (name, size) in enumerate(members):
+            self._sizes[name] = size
+            self._order[name] = j
+        self._members = members
+        self._solid = solid and None not in self._sizes.values()
+        self._files = self._prefix_archive([name for name, size in members])
+
     def open_file(self, name):
-        tmpdir = tempfile.mkdtemp()
-        name = self._unprefix_archive(name)
+        self._lock.acquire()
+        try:
+            event = self._pending.get(name)
+        finally:
+            self._lock.release()
+        if event is not None:
+            event.wait()
+
+        data = MEMBER_CACHE.get(name)
+        if data is None and self._solid:
+            data = self._get_stream(name).fetch(
+                self._order[self._unprefix_archive(name)])
+        if data is None:
+            member = self._unprefix_archive(name)
+            data = read_command_output(self._extract_command([member]))
+            MEMBER_CACHE.put(name, data)
+        return data
+
+    def _get_stream(self, name):
+        """Return a solid stream that will reach the given file"""
+        j = self._order[self._unprefix_archive(name)]
+        self._lock.acquire()
+        try:
+            stream = self._stream
+            if stream is None or not stream.will_reach(j):
+                if stream is not None:
+                    stream.close()
+                stream = SolidStream(self, j)
+                self._stream = stream
+            return stream
+        finally:
+            self._lock.release()
 
-        p = subprocess.Popen(["unrar", "e", self.archive, name,
-                              tmpdir + os.path.sep],
-                             stdout=subprocess.PIPE, stdin=subprocess.PIPE)
-        p.communicate()
-        
+    def prefetch(self, names):
+        """Extract the given files in one go to the member cache."""
+        self.files # make sure listing is there
+
+        if self._solid:
+            names = [name for name in names if name not in MEMBER_CACHE]
+            if names:
+                self._get_stream(min(names, key=lambda name: self._order[
+                    self._unprefix_archive(name)]))
+            return
+
+        event = threading.Event()
+        self._lock.acquire()
         try:
-            basename = os.path.basename(name)
-            return open(os.path.join(tmpdir, basename), 'r')
+            names = [name for name in names
+                     if name not in MEMBER_CACHE
+                     and name not in self._pending
+                     and self._sizes.get(self._unprefix_archive(name))
+                     is not None]
+            for name in names:
+                self._pending[name] = event
         finally:
-            shutil.rmtree(tmpdir)
+            self._lock.release()
 
-class SevenZipUnpacker(DummyUnpacker):
-    def _get_files(self):
-        p = subprocess.Popen(["7z", "l", self.archive],
-                             stdout=subprocess.PIPE,
-                             stdin=subprocess.PIPE)
-        out, err = p.communicate()
-        begun = False
-        lst = []
-        for line in out.split("\n"):
-            if not begun:
-                if line.startswith('-------'):
-                    begun = True
-                continue
-            if line.startswith('------'): break
-            lst.append(line[53:])
-        return self._prefix_archive(lst)
-    
-    def open_file(self, name):
-        tmpdir = tempfile.mkdtemp()
-        name = self._unprefix_archive(name)
+        if not names:
+            return
 
-        p = subprocess.Popen(["7z", "e", "-o%s" % tmpdir, self.archive, name],
-                             stdout=subprocess.PIPE, stdin=subprocess.PIPE)
-        p.communicate()
-        
         try:
-            basename = os.path.basename(name)
-            return open(os.path.join(tmpdir, basename), 'r')
-        finally:
-            shutil.rmtree(tmpdir)
+            members = [(self._order[member], member, name)
+                       for member, name in zip(map(self._unprefix_archive,
+                                                   names), names)]
+            members.sort()
+            try:
+                out = read_command_output(self._extract_command(
+                    [member for j, member, name in members]))
+            except IOError:
+                return
+
+            # Split the output; bail out if it doesn't add up
+            sizes = [self._sizes[member] for j, member, name in members]
+            if sum(sizes) != len(out):
+                return
+            pos = 0
+            for (j, member, name), size in zip(members, sizes):
+                MEMBER_CACHE.put(name, out[pos:pos+size])
+                pos += size
+            STATS.add('bytes.prefetched', pos)
+        finally:
+            self._lock.acquire()
+            try:
+                for name in names:
+                    del self._pending[name]
+            finally:
+                self._lock.release()
+            event.set()
+
+class SolidStream(object):
+    """
+    Sequential extraction of a solid archive, from a given member onwards.
+
+    A background thread reads the members from the unpacker program's
+    stdout to the member cache. It stays at most `lookahead` bytes ahead
+    of the members asked for via `fetch`; the program is paused by the
+    full pipe meanwhile.
+
+    Each stream holds a paused unpacker process and a thread, so only
+    the `max_active` most recently used streams (over all archives) are
+    kept open; older ones are closed when new ones start.
+    """
+
+    max_active = 2
+    _active = []
+    _active_lock = threading.Lock()
+
+    def __init__(self, unpacker, start, lookahead=MEMBER_CACHE_BYTES//2):
+        self.unpacker = unpacker
+        self.start = start
+        self.position = start # next member to come out
+        self.wanted = start   # last member asked for
+        self.lookahead = lookahead
+        self.closed = False
+        self.cond = threading.Condition()
+
+        members = [name for name, size in unpacker._members[start:]]
+        if start == 0:
+            members = [] # everything
+        try:
+            self.process = subprocess.Popen(
+                unpacker._extract_command(members),
+                stdout=subprocess.PIPE, stderr=open(os.devnull, 'w'),
+                stdin=subprocess.PIPE)
+        except OSError:
+            self.process = None
+            self.closed = True
+            return
+
+        thread = threading.Thread(target=self.__run)
+        thread.setDaemon(True)
+        thread.start()
+        self.__touch()
+
+    def __touch(self):
+        """Mark as most recently used, closing streams beyond the limit"""
+        if self.closed:
+            return
+        SolidStream._active_lock.acquire()
+        try:
+            active = SolidStream._active
+            if self in active:
+                active.remove(self)
+            active.append(self)
+            stale = active[:-self.max_active]
+            del active[:-self.max_active]
+        finally:
+            SolidStream._active_lock.release()
+        for stream in stale:
+            stream.close()
+
+    def will_reach(self, j):
+        """Whether member `j` is still to come out of this stream"""
+        return not self.closed and j >= self.position
+
+    def fetch(self, j):
+        """Wait for member `j` to be extracted, and return its data
+        (None if the stream did not reach it)."""
+        self.__touch()
+        self.cond.acquire()
+        try:
+            self.wanted = max(self.wanted, j)
+            self.cond.notifyAll()
+            while not self.closed and self.position <= j:
+                self.cond.wait()
+        finally:
+            self.cond.release()
+        name, size = self.unpacker._members[j]
+        return MEMBER_CACHE.get(self.unpacker._prefix_archive([name])[0])
+
+    def close(self):
+        self.cond.acquire()
+        try:
+            self.closed = True
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+        SolidStream._active_lock.acquire()
+        try:
+            if self in SolidStream._active:
+                SolidStream._active.remove(self)
+        finally:
+            SolidStream._active_lock.release()
+        if self.process is not None and self.process.returncode is None:
+            try:
+                os.kill(self.process.pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def __ahead(self):
+        return sum([size for name, size in
+                    self.unpacker._members[self.wanted+1:self.position]])
+
+    def __run(self):
+        members = self.unpacker._members
+        try:
+            for j in xrange(self.start, len(members)):
+                name, size = members[j]
+                data = self.process.stdout.read(size)
+                if len(data) != size:
+                    break
+                if j >= self.wanted:
+                    # members skipped over are not worth caching
+                    MEMBER_CACHE.put(self.unpacker._prefix_archive([name])[0],
+                                     data)
+                    STATS.add('bytes.prefetched', size)
+                del data
+
+                self.cond.acquire()
+                try:
+                    self.position = j + 1
+                    self.cond.notifyAll()
+                    while not self.closed and self.__ahead() > self.lookahead:
+                        self.cond.wait()
+                    if self.closed:
+                        break
+                finally:
+                    self.cond.release()
+        finally:
+            self.close()
+            self.process.stdout.close()
+            self.process.wait()
+
+def parse_listing(out, separator, start_marker=None):
+    """Parse 'key: value' blocks separated by empty lines, as output by
+    technical listings of archivers."""
+    blocks = []
+    block = {}
+    lines = out.split("\n")
+    if start_marker is not None:
+        try:
+            lines = lines[[line.strip() for line in lines].index(start_marker):]
+        except ValueError:
+            return []
+    for line in lines:
+        line = line.rstrip("\r")
+        if not line.strip():
+            if block:
+                blocks.append(block)
+            block = {}
+            continue
+        try:
+            key, value = line.split(separator, 1)
+        except ValueError:
+            continue
+        block[key.strip()] = value.strip()
+    if block:
+        blocks.append(block)
+    return blocks
+
+def _int_or_none(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+class RarUnpacker(CommandUnpacker):
+    def _list_members(self):
+        # An archive unrar can't list is treated as empty
+        try:
+            out = read_command_output(["unrar", "vt", self.archive])
+        except IOError:
+            out = ""
+        blocks = parse_listing(out, ":")
+        members = [(block['Name'], _int_or_none(block.get('Size')))
+                   for block in blocks
+                   if 'Name' in block and block.get('Type') != 'Directory']
+        solid = [block for block in blocks
+                 if 'solid' in block.get('Details', '').split(', ')] != []
+        if not members:
+            # old unrar, without a key-value technical listing
+            try:
+                out = read_command_output(["unrar", "vb", self.archive])
+            except IOError:
+                return [], False
+            members = [(fn.strip(), None) for fn in out.split("\n")
+                       if fn.strip()]
+        return members, solid
+
+    def _extract_command(self, names):
+        # unrar has no switch for literal names, but '*' and '?' can't
+        # occur in names of files archived on Windows anyway
+        return ["unrar", "p", "-inul", "--", self.archive] + names
+
+class SevenZipUnpacker(CommandUnpacker):
+    def _list_members(self):
+        try:
+            out = read_command_output(["7z", "l", "-slt", self.archive])
+        except IOError:
+            return [], False
+        members = [(block['Path'], _int_or_none(block.get('Size')))
+                   for block in parse_listing(out, " = ", "----------")
+                   if 'Path' in block and block.get('Folder') != '+'
+                   and not block.get('Attributes', '').startswith('D')]
+        solid = [block for block in parse_listing(out, " = ", "--")
+                 if block.get('Solid') == '+'] != []
+        return members, solid
+
+    def _extract_command(self, names):
+        # -spd: match the names literally, not as wildcards
+        return ["7z", "e", "-so", "-y", "-spd", "--", self.archive] + names
+
+def list_archive(unpacker):
+    """Return the files in the archive. The listing is cached on disk,
+    keyed by the identity (path, size, mtime) of the archive file."""
+    try:
+        identity = unpacker.get_identity()
+    except OSError:
+        return unpacker.files
+    listing = load_state('listing', identity)
+    if listing is not None:
+        unpacker.set_listing(listing)
+    elif unpacker.files:
+        # an empty listing may just mean the unpacker failed; not cached
+        save_state('listing', identity, unpacker.get_listing())
+    return unpacker.files
+
+def classify_path(path, unpackers):
+    """Return 'dir', 'archive' or 'file'"""
+    try:
+        mode = os.stat(path).st_mode
+    except OSError:
+        return 'file'
+    if stat.S_ISDIR(mode):
+        return 'dir'
+    elif stat.S_ISREG(mode) and path in unpackers:
+        return 'archive'
+    else:
+        return 'file'
+
+def list_directory(path, unpackers, keep_file=None):
+    """
+    Return [(path, kind), ...] for entries in a directory, in order.
+
+    Each entry costs at most one stat() call, and none if the file type
+    is available from the directory listing (via scandir). Plain files
+    for which ``keep_file(path)`` is false are dropped before sorting.
+    """
+    entries = []
+    if scandir is not None:
+        for entry in scandir(path):
+            try:
+                is_dir = entry.is_dir()
+                is_file = not is_dir and entry.is_file()
+            except OSError:
+                is_dir = is_file = False
+            if is_dir:
+                kind = 'dir'
+            elif is_file and entry.path in unpackers:
+                kind = 'archive'
+            else:
+                kind = 'file'
+            entries.append((entry.path, kind))
+    else:
+        for fn in os.listdir(path):
+            fn = os.path.join(path, fn)
+            entries.append((fn, classify_path(fn, unpackers)))
+
+    if keep_file is not None:
+        entries = [(fn, kind) for fn, kind in entries
+                   if kind != 'file' or keep_file(fn)]
+
+    kinds = dict(entries)
+    return [(fn, kinds[fn]) for fn in numeric_file_sort(kinds.keys())]
+
+def expand_path(path, kind, unpackers, progress=None, keep_file=None):
+    """List the contents of a directory or an archive.
+
+    :Returns:
+        For directories, [(path, kind), ...] of the entries, and for
+        archives, ([file, ...], {file: unpacker, ...}).
+    """
+    if progress: progress(os.path.basename(path))
+    if kind == 'dir':
+        try:
+            return list_directory(path, unpackers, keep_file)
+        except OSError:
+            return []
+    else:
+        # A broken or unreadable archive is skipped, not fatal to the scan
+        try:
+            unpacker = unpackers[path](os.path.abspath(path))
+            return expand_archive(unpacker, unpackers, keep_file)
+        except (IOError, OSError, zipfile.BadZipfile, tarfile.TarError):
+            return [], {}
+
+def expand_archive(unpacker, unpackers, keep_file=None, depth=0):
+    """
+    Return ([file, ...], {file: unpacker, ...}) for files in an archive.
+
+    Archives inside the archive are expanded recursively. They are read
+    from the outer archive, without extracting anything to disk.
+    """
+    files = []
+    file_unpackers = {}
+    for fn in numeric_file_sort([fn for fn in list_archive(unpacker)
+                                 if keep_file is None or keep_file(fn)
+                                 or fn in unpackers]):
+        nested = None
+        if fn in unpackers and depth < MAX_NESTING:
+            try:
+                nested = unpacker.open_nested(fn, unpackers[fn])
+                if nested is not None:
+                    fns, ups = expand_archive(nested, unpackers, keep_file,
+                                              depth + 1)
+            except (IOError, OSError, zipfile.BadZipfile, tarfile.TarError):
+                nested = None
+        if nested is not None:
+            files += fns
+            file_unpackers.update(ups)
+        elif keep_file is None or keep_file(fn):
+            files.append(fn)
+            file_unpackers[fn] = unpacker
+    return files, file_unpackers
+
+def iter_find(dirname, unpackers, pool, progress=None, keep_file=None):
+    """
+    Find all files under dirname, with associated unpackers (if any).
+
+    Directories and archives are listed in parallel on the worker pool,
+    ahead of the current position, while the results are yielded in
+    order as soon as they are available.
+
+    If `keep_file` is given, plain files and archive members for which
+    ``keep_file(path)`` is false are skipped.
+
+    :Yields: ([file, ...], {file: unpacker, ...}) batches
+    """
+    path = os.path.abspath(dirname)
+    kind = classify_path(path, unpackers)
+    if kind == 'file':
+        if keep_file is None or keep_file(path):
+            yield [path], {}
+        return
+
+    # Depth-first walk. Jobs are prioritized by their position in the
+    # walk; a tuple of indices sorts in the depth-first order
+    stack = [iter([(path, (), pool.submit((), expand_path, path, kind,
+                                          unpackers, progress,
+                                          keep_file))])]
+    files = []
+    while stack:
+        try:
+            path, order, job = stack[-1].next()
+        except StopIteration:
+            stack.pop()
+            continue
 
-def recursive_find(dirname, unpackers, progress_queue=None):
-    """Return all files under dirname, with associated unpackers (if any)."""
-    pathlist = [ os.path.abspath(dirname) ]
-    files = []
-    file_unpackers = {}
-    
-    while len(pathlist) > 0:
-        path = pathlist[0]
-        del pathlist[0]
-        
-        if os.path.isdir(path):
-            if progress_queue: progress_queue.put(os.path.basename(path))
-
-            for fn in reversed(numeric_file_sort([os.path.join(path, i)
-                                                  for i in os.listdir(path)])):
-                pathlist.insert(0, fn)
-        elif os.path.isfile(path) and path in unpackers:
-            if progress_queue: progress_queue.put(os.path.basename(path))
-            unpacker = unpackers[path](os.path.abspath(path))
+        if job is None:
+            files.append(path)
+            continue
+
+        if files:
+            yield files, {}
+            files = []
 
-            add_list = numeric_file_sort(unpacker.files)
-            for fn in add_list:
-                file_unpackers[fn] = unpacker
-            files += add_list
+        result = job.wait()
+        if isinstance(result, tuple):
+            yield result
         else:
-            files.append(path)
-    
-    return files, file_unpackers
+            children = []
+            for j, (fn, kind) in enumerate(result):
+                if kind == 'file':
+                    children.append((fn, None, None))
+                else:
+                    children.append((fn, order + (j,),
+                                     pool.submit(order + (j,), expand_path,
+                                                 fn, kind, unpackers,
+                                                 progress, keep_file)))
+            stack.append(iter(children))
+
+    if files:
+        yield files, {}
 
 class FileList(object):
     """Get a list of files in given sources, including contents of archives,
@@ -332,22 +1868,63 @@ class FileList(object):
         '.7z': SevenZipUnpacker,
         })
 
-    def __init__(self, filenames, extensionlist=None, progress_queue=None):
+    def __init__(self, filenames, extensionlist=None, progress_queue=None,
+                 scan=True):
         if not isinstance(filenames, list):
             filenames = [filenames]
-        
-        # Recursive find
+
+        self.filenames = filenames
+        self.extensionlist = extensionlist
+        self.progress_queue = progress_queue
+        self.complete = False
+        self.cancelled = False
+        self.readahead = READAHEAD_HINTS
         self._files = []
         self._file_unpackers = {}
-        for filename in filenames:
-            fns, ups = recursive_find(filename, FileList.zip_extension_map,
-                                      progress_queue)
-            self._files += fns
-            self._file_unpackers.update(ups)
-        
-        if extensionlist:
-            self._files = [i for i in self._files
-                           if os.path.splitext(i)[1].lower() in extensionlist]
+        self._advised = set()
+
+        if scan:
+            self.scan()
+
+    def scan(self, callback=None):
+        """
+        Find the files in the sources, recursively.
+
+        The list grows as the files are found; `callback()` is called after
+        each addition, and when the scan is complete. The scan stops early
+        if `cancel` is called.
+        """
+        def progress(text):
+            queue = self.progress_queue
+            if queue: queue.put(text)
+
+        if self.extensionlist:
+            keep_file = ExtensionMap(dict.fromkeys(self.extensionlist,
+                                                   True)).has_key
+        else:
+            keep_file = None
+
+        pool = WorkerPool(SCAN_THREADS)
+        try:
+            for filename in self.filenames:
+                for fns, ups in iter_find(filename,
+                                          FileList.zip_extension_map,
+                                          pool, progress, keep_file):
+                    if self.cancelled:
+                        return
+                    if not fns:
+                        continue
+                    self._file_unpackers.update(ups)
+                    self._files.extend(fns)
+                    if callback: callback()
+        finally:
+            pool.close()
+            self.complete = True
+            if callback: callback()
+
+    def cancel(self):
+        """Stop a running `scan`"""
+        self.cancelled = True
 
     def __str__(self):
         return str(self._files)
@@ -359,92 +1936,1000 @@ class FileList(object):
         return len(self._files)
 
     def open_file(self, fn):
+        data = MEMBER_CACHE.get(fn)
+        if data is not None:
+            STATS.add('bytes.hit')
+            return data
+        STATS.add('bytes.miss')
         unpacker = self._file_unpackers.get(fn)
         if unpacker:
             return unpacker.open_file(fn)
         else:
             return open(fn, 'r')
 
+    def prefetch(self, fns, max_bytes=None):
+        """
+        Read the given files ahead of time to the member cache, in order,
+        as long as they fit in `max_bytes` (by default 3/4 of the cache).
+        Archives are read one batch per archive.
+        """
+        if max_bytes is None:
+            max_bytes = MEMBER_CACHE.max_size * 3 // 4
+        if self.readahead:
+            self.advise(fns)
+        batches = {}
+        unpackers = []
+        total = 0
+        for fn in fns:
+            unpacker = self._file_unpackers.get(fn)
+            try:
+                if unpacker is None:
+                    size = os.stat(fn).st_size
+                else:
+                    size = unpacker._member_size(fn)
+            except (OSError, KeyError, ValueError):
+                continue
+            total += size or 0
+            if total > max_bytes:
+                break
+            if fn in MEMBER_CACHE:
+                continue
+            if unpacker not in batches:
+                batches[unpacker] = []
+                unpackers.append(unpacker)
+            batches[unpacker].append(fn)
+        for unpacker in unpackers:
+            if unpacker is None:
+                for fn in batches[unpacker]:
+                    read_ahead(fn, lambda fn=fn: open(fn, 'rb'))
+            else:
+                unpacker.prefetch(batches[unpacker])
+
+    def advise(self, fns):
+        """Hint the kernel to read the data of the given files ahead"""
+        for fn in fns:
+            if fn in self._advised or fn in MEMBER_CACHE:
+                continue
+            unpacker = self._file_unpackers.get(fn)
+            try:
+                if unpacker is None:
+                    byte_range = (fn, 0, 0)
+                else:
+                    byte_range = unpacker._member_range(fn)
+            except (KeyError, ValueError, IOError, OSError):
+                continue
+            if byte_range is None:
+                continue
+            if len(self._advised) > 4096:
+                self._advised.clear()
+            self._advised.add(fn)
+            advise_willneed(*byte_range)
+
 ##############################################################################
 ## ImageCache / ImageView
 ##############################################################################
 
-class ImageCache(object):
-    def __init__(self, filelist, max_items=MAX_IMAGE_CACHE):
-        self.raw_pixbufs = {}
-        self.scaled_pixbufs = {}
-        self.filenames = []
-        self.filelist = filelist
-        self.max_items = max_items
-        self.interpolation = gtk.gdk.INTERP_BILINEAR
+LOADER_CHUNK_SIZE = 64*1024
+
+# Image loader types, by file name extension
+LOADER_TYPES = ExtensionMap({
+    '.jpg': 'jpeg',
+    '.gif': 'gif',
+    '.png': 'png',
+    '.tif': 'tiff',
+    '.tiff': 'tiff',
+    '.bmp': 'bmp',
+    })
+
+def new_pixbuf_loader(filename=None):
+    """Return a PixbufLoader, for the image type of the file if known"""
+    image_type = LOADER_TYPES.get(filename or "")
+    if image_type is not None:
+        try:
+            return gtk.gdk.PixbufLoader(image_type)
+        except gobject.GError:
+            pass
+    return gtk.gdk.PixbufLoader()
+
+class ImageError(IOError):
+    """The image data could not be decoded"""
+
+def read_chunks(data, chunk_size, seen):
+    """Yield a string or a file-like object in chunks, appending them
+    also to the list `seen`, so that they can be fed again."""
+    if isinstance(data, str):
+        seen.append(data)
+        yield data
+        return
+    while True:
+        chunk = data.read(chunk_size)
+        if not chunk:
+            break
+        seen.append(chunk)
+        yield chunk
+
+def with_untyped_retry(func, data, filename, chunk_size):
+    """
+    Call ``func(loader, chunks)`` with a loader for the file type, and if
+    that raises ImageError, once more with a loader detecting the type
+    from the data: files are sometimes misnamed (eg. a PNG called .jpg).
+    The chunks already read are fed again to the second loader.
+    """
+    seen = []
+    chunks = read_chunks(data, chunk_size, seen)
+    if LOADER_TYPES.get(filename or "") is None:
+        return func(gtk.gdk.PixbufLoader(), chunks)
+    try:
+        return func(new_pixbuf_loader(filename), chunks)
+    except ImageError:
+        STATS.add('decode.untyped_retries')
+    return func(gtk.gdk.PixbufLoader(), itertools.chain(list(seen), chunks))
+
+def decode_image(data, filename=None, fit=None):
+    """
+    Decode an image from a string or a file-like object in memory.
 
-    @assert_gui_thread
-    def add(self, filename):
-        if filename in self.filenames:
-            return # noop
-        
-        # cleanup cache, if necessary
-        if len(self.filenames) + 1 > self.max_items:
+    File-like objects are fed to the loader in chunks as they are read.
+    If `fit` = (width, height) is given, larger images are decoded
+    downscaled to fit inside it. The JPEG loader does this with DCT
+    scaling, so the full-size image is never built.
+
+    :Returns: (pixbuf, (full_width, full_height))
+    :Raises: ImageError if the image cannot be decoded, IOError if
+             reading the data fails.
+    """
+    def decode(loader, chunks):
+        full_size = [None, None]
+        def size_prepared(loader, width, height):
+            full_size[:] = [width, height]
+            if fit is None:
+                return
+            ratio = min(fit[0] / width, fit[1] / height)
+            if ratio < 1:
+                loader.set_size(max(1, int(width*ratio + .5)),
+                                max(1, int(height*ratio + .5)))
+        loader.connect('size-prepared', size_prepared)
+        try:
+            for chunk in chunks:
+                loader.write(chunk)
+            loader.close()
+        except gobject.GError, e:
             try:
-                del self.raw_pixbufs[self.filenames[0]]
-            except KeyError:
+                loader.close()
+            except gobject.GError:
                 pass
+            raise ImageError("%s: %s" % (filename, e))
+        pixbuf = loader.get_pixbuf()
+        if pixbuf is None:
+            raise ImageError("%s: cannot decode image" % filename)
+        if full_size[0] is None:
+            full_size = [pixbuf.get_width(), pixbuf.get_height()]
+        return pixbuf, tuple(full_size)
+    return with_untyped_retry(decode, data, filename, LOADER_CHUNK_SIZE)
+
+HEADER_CHUNK_SIZE = 4096
+
+def read_image_size(data, filename=None):
+    """
+    Read the (width, height) of an image from a string or a file-like
+    object, feeding the loader only until it has parsed the header.
+
+    :Raises: ImageError if the header cannot be parsed.
+    """
+    if isinstance(data, str):
+        data = StringIO.StringIO(data)
+    def read_size(loader, chunks):
+        size = []
+        def size_prepared(loader, width, height):
+            size[:] = [width, height]
+            loader.set_size(1, 1) # decode as little as possible
+        loader.connect('size-prepared', size_prepared)
+        try:
+            try:
+                for chunk in chunks:
+                    loader.write(chunk)
+                    if size:
+                        break
+            except gobject.GError, e:
+                raise ImageError("%s: %s" % (filename, e))
+        finally:
             try:
-                del self.scaled_pixbufs[self.filenames[0]]
-            except KeyError:
+                loader.close() # complains about the missing image data
+            except gobject.GError:
                 pass
-            del self.filenames[0]
-            gc.collect()
+        if not size:
+            raise ImageError("%s: cannot read image header" % filename)
+        return tuple(size)
+    return with_untyped_retry(read_size, data, filename, HEADER_CHUNK_SIZE)
 
-        # load image (aargh, gtk.gdk.PixbufLoader doesn't work properly...)
+# Size of images known not to be decodable
+BROKEN_SIZE = (0, 0)
+
+class SizeIndex(object):
+    """
+    Image dimensions, read from image headers without decoding. Thread-safe.
+
+    Images that cannot be decoded are recorded with `BROKEN_SIZE`. The
+    sizes of archive members are stored on disk per archive, and loaded
+    the first time a member of the archive is looked up. Broken images
+    are not stored, but tried again in the next session.
+    """
+
+    def __init__(self, filelist):
+        self.filelist = filelist
+        self.lock = threading.RLock()
+        self.sizes = {}
+        self.loaded = set()
+        self.dirty = {}
+
+    def get(self, filename):
+        """Return (width, height) of the image, or None if not known"""
+        self.lock.acquire()
+        try:
+            size = self.sizes.get(filename)
+            if size is None:
+                unpacker = self.filelist._file_unpackers.get(filename)
+                if unpacker is not None and unpacker not in self.loaded:
+                    self.loaded.add(unpacker)
+                    stored = load_state('sizes', unpacker.get_identity())
+                    if stored:
+                        for name, value in stored.iteritems():
+                            if value != BROKEN_SIZE:
+                                self.sizes.setdefault(name, value)
+                        size = self.sizes.get(filename)
+            return size
+        finally:
+            self.lock.release()
+
+    def set(self, filename, size):
+        self.lock.acquire()
+        try:
+            size = tuple(size)
+            if self.sizes.get(filename) == size:
+                return
+            self.sizes[filename] = size
+            unpacker = self.filelist._file_unpackers.get(filename)
+            if unpacker is not None:
+                self.dirty[unpacker] = True
+        finally:
+            self.lock.release()
+
+    def probe(self, filename):
+        """
+        Read the size of an image from its header, and record it.
+        Images whose headers can't be parsed get `BROKEN_SIZE`.
+
+        :Raises: IOError if the file cannot be read.
+        """
+        size = self.get(filename)
+        if size is not None:
+            return size
         if os.path.isfile(filename):
-            raw_pixbuf = gtk.gdk.pixbuf_new_from_file(filename)
+            info = gtk.gdk.pixbuf_get_file_info(filename)
+            if info is None:
+                size = BROKEN_SIZE
+            else:
+                size = info[1:3]
         else:
-            f=tempfile.NamedTemporaryFile(suffix=os.path.splitext(filename)[1])
             fh = self.filelist.open_file(filename)
-            if isinstance(fh, str):
-                f.write(fh)
+            try:
+                try:
+                    size = read_image_size(fh, filename)
+                except ImageError:
+                    size = BROKEN_SIZE
+            finally:
+                if not isinstance(fh, str):
+                    fh.close()
+        self.set(filename, size)
+        return size
+
+    def save(self):
+        """Store the sizes of archive members added since the last save"""
+        self.lock.acquire()
+        try:
+            unpackers = self.dirty.keys()
+            self.dirty.clear()
+            tables = []
+            for unpacker in unpackers:
+                names = unpacker.files
+                tables.append((unpacker, dict(
+                    (name, self.sizes[name]) for name in names
+                    if self.sizes.get(name, BROKEN_SIZE) != BROKEN_SIZE)))
+        finally:
+            self.lock.release()
+        for unpacker, table in tables:
+            save_state('sizes', unpacker.get_identity(), table)
+
+# Image load priorities, most urgent first. Jump targets are decoded
+# into a separate small cache, see `ImageCache`.
+LOAD_VISIBLE, LOAD_NEXT, LOAD_PREVIOUS, LOAD_SPECULATIVE, LOAD_JUMP = range(5)
+# Writing decoded images to the disk cache waits for all loads
+STORE_RENDITION = LOAD_JUMP + 1
+# Decoded images waiting to be written to the disk cache, at most
+MAX_PENDING_STORES = 4
+
+# Seconds until an image that failed to load for other reasons than bad
+# data (eg. an unreadable file) is tried again
+RETRY_FAILED_DELAY = 30
+
+def pixbuf_size(pixbuf):
+    """Memory used by the pixel data of a pixbuf, in bytes"""
+    return pixbuf.get_rowstride() * pixbuf.get_height()
+
+class RenditionCache(object):
+    """
+    Screen-sized images stored on disk as JPEG, so that pages seen before
+    need not be read from the archive and decoded again. Thread-safe.
+
+    Renditions are keyed by the identity of the source file and the size
+    they were made to fit. When the cache grows over `max_bytes`, the
+    least recently used ones are removed.
+    """
+
+    def __init__(self, filelist, max_bytes=DISK_CACHE_BYTES,
+                 quality=DISK_CACHE_QUALITY):
+        self.filelist = filelist
+        self.max_bytes = max_bytes
+        self.quality = quality
+        self.index_path = state_path('renditions', 'index')
+        self.path = os.path.dirname(self.index_path)
+        self.lock = threading.Lock()
+        self.entries = None # {key: [full_size, nbytes, last_used]}
+        self.size = 0
+        self.dirty = False
+
+    def get(self, filename, fit):
+        """Return (pixbuf, full_size) for a stored rendition, or None"""
+        key = self.__key(filename, fit)
+        self.lock.acquire()
+        try:
+            self.__load()
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            entry[2] = time.time()
+            self.dirty = True
+            full_size = entry[0]
+        finally:
+            self.lock.release()
+        try:
+            pixbuf = gtk.gdk.pixbuf_new_from_file(self.__filename(key))
+        except gobject.GError:
+            self.lock.acquire()
+            try:
+                self.__remove(key)
+            finally:
+                self.lock.release()
+            return None
+        return pixbuf, full_size
+
+    def put(self, filename, fit, pixbuf, full_size):
+        """Store a rendition of a file made to fit in `fit`"""
+        key = self.__key(filename, fit)
+        path = self.__filename(key)
+        try:
+            pixbuf.save(path + '.new', 'jpeg',
+                        {'quality': str(self.quality)})
+            os.rename(path + '.new', path)
+            nbytes = os.stat(path).st_size
+        except (gobject.GError, IOError, OSError):
+            return
+        self.lock.acquire()
+        try:
+            self.__load()
+            if key in self.entries:
+                self.size -= self.entries[key][1]
+            self.entries[key] = [tuple(full_size), nbytes, time.time()]
+            self.size += nbytes
+            self.dirty = True
+            if self.size > self.max_bytes:
+                self.__prune(self.max_bytes * 3 // 4)
+        finally:
+            self.lock.release()
+
+    def save(self):
+        """Store the list of renditions, if it has changed"""
+        self.lock.acquire()
+        try:
+            if not self.dirty:
+                return
+            self.dirty = False
+            entries = dict(self.entries)
+        finally:
+            self.lock.release()
+        path = self.index_path
+        try:
+            f = open(path + '.new', 'wb')
+            try:
+                pickle.dump(entries, f, pickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            os.rename(path + '.new', path)
+        except (IOError, OSError):
+            pass
+
+    def __key(self, filename, fit):
+        unpacker = self.filelist._file_unpackers.get(filename)
+        if unpacker is not None:
+            identity = unpacker.get_identity()
+        else:
+            identity = file_identity(filename)
+        return hashlib.md5(repr((identity, filename, tuple(fit)))).hexdigest()
+
+    def __filename(self, key):
+        return os.path.join(self.path, key + '.jpg')
+
+    def __load(self):
+        if self.entries is not None:
+            return
+        try:
+            f = open(self.index_path, 'rb')
+            try:
+                self.entries = pickle.load(f)
+            finally:
+                f.close()
+        except (IOError, OSError, EOFError, ValueError,
+                pickle.UnpicklingError):
+            self.entries = {}
+        self.size = sum([entry[1] for entry in self.entries.itervalues()])
+
+    def __remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+            self.dirty = True
+        try:
+            os.unlink(self.__filename(key))
+        except OSError:
+            pass
+
+    def __prune(self, max_bytes):
+        by_age = [(entry[2], key) for key, entry in self.entries.iteritems()]
+        by_age.sort()
+        for last_used, key in by_age:
+            if self.size <= max_bytes:
+                break
+            self.__remove(key)
+
+class ImageCache(object):
+    """
+    Decoded images, loaded in background threads.
+
+    `get` and `get_scaled` return None for images that are not loaded
+    yet, and queue them for decoding; the functions in `loaded_callbacks`
+    are called with the file name (in the GUI thread) when one arrives.
+
+    Raw and scaled images share one LRU budget of `max_bytes`. Scaled
+    images are keyed by (file, width, height, rotation, interpolation), so
+    switching between layouts reuses the variants made earlier. Images of
+    the files passed to `pin` are kept even if they don't fit in it.
+
+    Images loaded with priority LOAD_JUMP (places the reader may jump to)
+    go to a separate `warm` cache of WARM_CACHE_BYTES, so that they don't
+    push out the pages around the current one. They move to the main
+    cache when shown.
+
+    For the screen (LOAD_VISIBLE), `get_scaled` first returns a quick
+    INTERP_NEAREST preview, and makes the image with the chosen
+    interpolation later when idle, calling the `loaded_callbacks` again.
+
+    In `reduced` mode, images are decoded only as large as needed to
+    fill `fit_size`, again when `fit_size` grows, and at full resolution
+    when a scaled image larger than that is asked for (when zooming in). `get_size` always gives the
+    full size, from the `SizeIndex` if possible. Reduced images are also
+    kept in the `RenditionCache` on disk, if `disk_cache` is set.
+
+    Images that cannot be decoded are not tried again. After other
+    errors, loading is retried once RETRY_FAILED_DELAY seconds have
+    passed.
+    """
+
+    RAW, SCALED = range(2)
+
+    def __init__(self, filelist, max_bytes=IMAGE_CACHE_BYTES,
+                 nthreads=DECODE_THREADS, reduced=True, disk_cache=True):
+        self.reduced = reduced
+        self.fit_size = None
+        self.index = SizeIndex(filelist)
+        self.renditions = None
+        if disk_cache and reduced and DISK_CACHE_BYTES > 0:
+            try:
+                self.renditions = RenditionCache(filelist)
+            except OSError:
+                pass # no writable ~/.pai
+        self.save_pending = False
+        self.pixbufs = LRUCache(max_bytes, pixbuf_size)
+        self.warm = LRUCache(WARM_CACHE_BYTES, pixbuf_size)
+        self.pinned = {}
+        self.pinned_files = set()
+        self.collect_pending = False
+        self.filelist = filelist
+        self.interpolation = gtk.gdk.INTERP_BILINEAR
+        self.pool = WorkerPool(nthreads)
+        self.jobs = {}
+        self.probes = {}
+        self.refinements = {}
+        self.refine_pending = False
+        self.decode_time = 0.2 # seconds per image, running average
+        self.failed = {}
+        self.stores = [] # (filename, fit, pixbuf, full_size) to write
+        self.store_queued = False
+        self.store_lock = threading.Lock()
+        self.loaded_callbacks = []
+
+    @assert_gui_thread
+    def set_fit_size(self, width, height):
+        """Set the size reduced-mode images are decoded to fit in"""
+        self.fit_size = (max(1, int(width)), max(1, int(height)))
+
+    @assert_gui_thread
+    def request(self, filename, priority=LOAD_VISIBLE, full=False):
+        """
+        Queue an image for decoding, unless it's loaded already.
+
+        With `full`, a reduced-size image is decoded again at full size.
+        """
+        if self.__get_error(filename) is not None:
+            return
+        raw_pixbuf = self.__lookup((filename, ImageCache.RAW))
+        if raw_pixbuf is None:
+            raw_pixbuf = self.warm.get((filename, ImageCache.RAW))
+        if raw_pixbuf is not None:
+            if self.__is_full_size(filename, raw_pixbuf):
+                return
+            if not full:
+                # decoded for a smaller window: again if it has grown
+                fit_size = self.__fit_decode_size(filename)
+                if (fit_size is None
+                        or raw_pixbuf.get_width() + 1 >= fit_size[0]):
+                    return
+        if self.reduced and not full:
+            fit = self.fit_size
+        else:
+            fit = None
+        job = self.jobs.get(filename)
+        if job is not None:
+            job_fit = job.a[1]
+            big_enough = job_fit is None or (
+                fit is not None and job_fit[0] >= fit[0]
+                and job_fit[1] >= fit[1])
+            if (job.priority <= priority or job.started) and big_enough:
+                return
+            job.cancel() # requeue with a higher priority or size
+            if job_fit is None:
+                fit = None
+        self.jobs[filename] = self.pool.submit(priority, self.__decode,
+                                               filename, fit,
+                                               priority >= LOAD_JUMP)
+
+    @assert_gui_thread
+    def reschedule(self, plan):
+        """
+        Make the queued loads follow `plan`, a list of (priority, filename)
+        in order of urgency: loads of other files that have not started
+        yet are cancelled, the rest are requeued with their new
+        priorities, and missing ones are queued. Disk cache writes of
+        other files that have not started are dropped.
+        """
+        wanted = {}
+        for priority, filename in plan:
+            if filename not in wanted:
+                wanted[filename] = priority
+        self.__drop_stores(wanted)
+        queues = [(self.jobs, self.__decode), (self.probes, self.__probe)]
+        for jobs, func in queues:
+            for filename, job in jobs.items():
+                if job.started:
+                    continue
+                priority = wanted.get(filename)
+                if priority is None:
+                    job.cancel()
+                    del jobs[filename]
+                elif priority != job.priority:
+                    job.cancel()
+                    a = job.a
+                    if func == self.__decode:
+                        a = a[:2] + (priority >= LOAD_JUMP,)
+                    jobs[filename] = self.pool.submit(priority, func, *a)
+        for priority, filename in plan:
+            self.request(filename, priority)
+
+    def __decode(self, filename, fit, warm=False):
+        """Load an image. Runs in a worker thread."""
+        start = time.time()
+        pixbuf = None
+        full_size = None
+        error = None
+        store_fit = None
+        try:
+            rendition = None
+            if fit is not None and self.renditions is not None:
+                rendition = self.renditions.get(filename, fit)
+            if rendition is not None:
+                pixbuf, full_size = rendition
+                STATS.add('decode.renditions')
+            elif fit is None and os.path.isfile(filename):
+                pixbuf = gtk.gdk.pixbuf_new_from_file(filename)
+                full_size = (pixbuf.get_width(), pixbuf.get_height())
             else:
+                fh = self.filelist.open_file(filename)
                 try:
-                    shutil.copyfileobj(fh, f)
+                    try:
+                        pixbuf, full_size = decode_image(fh, filename, fit)
+                    except ImageError:
+                        full_size = BROKEN_SIZE
+                        raise
                 finally:
-                    fh.close()
-            f.flush()
-            raw_pixbuf = gtk.gdk.pixbuf_new_from_file(f.name)
-            f.close()
+                    if not isinstance(fh, str):
+                        fh.close()
+                if (fit is not None and self.renditions is not None
+                        and pixbuf.get_width() < full_size[0]):
+                    store_fit = fit
+        except (IOError, OSError, gobject.GError), error:
+            if isinstance(error, gobject.GError):
+                full_size = BROKEN_SIZE
+        except:
+            traceback.print_exc()
+            error = IOError("Failed to load %s" % filename)
+        elapsed = time.time() - start
+        self.decode_time = .8*self.decode_time + .2*elapsed
+        STATS.add('decode.images')
+        STATS.add('decode.seconds', elapsed)
+        run_in_gui_thread(self.__decoded, filename, pixbuf, full_size, error,
+                          warm, store_fit)
 
-        # process
-        self.filenames.append(filename)
-        self.raw_pixbufs[filename] = raw_pixbuf
+    @assert_gui_thread
+    def __decoded(self, filename, pixbuf, full_size, error, warm,
+                  store_fit=None):
+        try:
+            del self.jobs[filename]
+        except KeyError:
+            pass
+        if store_fit is not None:
+            self.__store_rendition_later(filename, store_fit, pixbuf,
+                                         full_size)
+        if full_size is not None:
+            self.index.set(filename, full_size)
+            self.__save_index_later()
+        if error is not None:
+            self.__set_error(filename, error, full_size == BROKEN_SIZE)
+        elif warm:
+            if self.__lookup((filename, ImageCache.RAW)) is None:
+                self.warm.put((filename, ImageCache.RAW), pixbuf)
+        else:
+            old_pixbuf = self.__lookup((filename, ImageCache.RAW))
+            if (old_pixbuf is None
+                    or old_pixbuf.get_width() < pixbuf.get_width()):
+                # scaled images made from the old one are too blurry
+                self.__drop_scaled(filename)
+                self.add(filename, pixbuf)
+            del old_pixbuf
+        for callback in self.loaded_callbacks:
+            callback(filename)
+
+    def __store_rendition_later(self, filename, fit, pixbuf, full_size):
+        """Queue a reduced image to be written to the disk cache when no
+        loads are waiting. The pixbufs waiting are outside the cache
+        budget, so only the last MAX_PENDING_STORES are kept."""
+        self.store_lock.acquire()
+        try:
+            stores = [item for item in self.stores if item[0] != filename]
+            stores.append((filename, fit, pixbuf, full_size))
+            self.stores = stores[-MAX_PENDING_STORES:]
+            if self.store_queued:
+                return
+            self.store_queued = True
+        finally:
+            self.store_lock.release()
+        self.pool.submit(STORE_RENDITION, self.__store_renditions)
 
-    def set_interpolation(self, interpolation):
-        self.scaled_pixbufs = {}
-        self.interpolation = interpolation
+    def __drop_stores(self, keep):
+        """Forget the queued disk cache writes of files not in `keep`"""
+        self.store_lock.acquire()
+        try:
+            self.stores = [item for item in self.stores if item[0] in keep]
+        finally:
+            self.store_lock.release()
 
-    def get(self, filename):
-        self.add(filename)
-        return self.raw_pixbufs[filename]
+    def __store_renditions(self):
+        """Write the queued images to the disk cache. Runs in a worker
+        thread."""
+        while True:
+            self.store_lock.acquire()
+            try:
+                if not self.stores:
+                    self.store_queued = False
+                    return
+                filename, fit, pixbuf, full_size = self.stores.pop(0)
+            finally:
+                self.store_lock.release()
+            self.renditions.put(filename, fit, pixbuf, full_size)
+            del pixbuf
+
+    def __probe(self, filename):
+        """Read the size of an image. Runs in a worker thread."""
+        error = None
+        try:
+            self.index.probe(filename)
+        except (IOError, OSError), error:
+            pass
+        except:
+            traceback.print_exc()
+            error = IOError("Failed to load %s" % filename)
+        run_in_gui_thread(self.__probed, filename, error)
 
     @assert_gui_thread
-    def get_scaled(self, filename, width, height, rotated=False):
-        self.add(filename)
+    def __probed(self, filename, error):
         try:
-            pixbuf = self.scaled_pixbufs[filename]
-            if pixbuf.get_width() != width or pixbuf.get_height() != height:
-                raise KeyError(filename)
-            return pixbuf
+            del self.probes[filename]
         except KeyError:
-            pixbuf = self.raw_pixbufs[filename]
-            if rotated:
-                pixbuf = pixbuf.rotate_simple(
-                    gtk.gdk.PIXBUF_ROTATE_CLOCKWISE)
-            if width != pixbuf.get_width() or height != pixbuf.get_height():
-                pixbuf = pixbuf.scale_simple(width, height,
-                                             self.interpolation)
-            self.scaled_pixbufs[filename] = pixbuf
+            pass
+        if error is not None:
+            self.__set_error(filename, error)
+        self.__save_index_later()
+        for callback in self.loaded_callbacks:
+            callback(filename)
+
+    def __save_index_later(self, delay=5000):
+        if self.save_pending:
+            return
+        self.save_pending = True
+        def save():
+            self.save_pending = False
+            self.index.save()
+            if self.renditions is not None:
+                self.renditions.save()
+        run_later_in_gui_thread(delay, save)
+
+    def __fit_decode_size(self, filename):
+        """Return the size of the image decoded to fit in `fit_size`, or
+        None if not known"""
+        size = self.index.get(filename)
+        if (not self.reduced or self.fit_size is None or size is None
+                or size == BROKEN_SIZE):
+            return None
+        ratio = min(self.fit_size[0] / size[0], self.fit_size[1] / size[1], 1)
+        return (max(1, int(size[0]*ratio + .5)),
+                max(1, int(size[1]*ratio + .5)))
+
+    def __is_full_size(self, filename, pixbuf):
+        size = self.index.get(filename)
+        return (size is None
+                or (pixbuf.get_width(), pixbuf.get_height()) == size)
+
+    @assert_gui_thread
+    def add(self, filename, raw_pixbuf):
+        self.__store((filename, ImageCache.RAW), raw_pixbuf)
+
+    @assert_gui_thread
+    def pin(self, filenames):
+        """Keep the images of these files (and only these) over budget.
+        Pending refinements of other files are cancelled."""
+        self.pinned_files = set(filenames)
+        for key in self.pinned.keys():
+            if key[0] not in self.pinned_files:
+                del self.pinned[key]
+        for key in self.refinements.keys():
+            if key[0] not in self.pinned_files:
+                del self.refinements[key]
+        for key in self.pixbufs.map.keys():
+            if key[0] in self.pinned_files:
+                pixbuf = self.pixbufs.get(key)
+                if pixbuf is not None:
+                    self.pinned[key] = pixbuf
+
+    def __store(self, key, pixbuf):
+        self.pixbufs.put(key, pixbuf)
+        if key[0] in self.pinned_files:
+            self.pinned[key] = pixbuf
+        if IDLE_GC:
+            self.__collect_later()
+
+    def __collect_later(self):
+        """Run the garbage collector once the GUI has nothing else to do.
+
+        Pixbufs are freed as soon as the cache drops them; this only
+        mops up reference cycles elsewhere, off the page-turn path.
+        """
+        if self.collect_pending:
+            return
+        self.collect_pending = True
+        def collect():
+            self.collect_pending = False
             gc.collect()
+            return False
+        gobject.idle_add(collect, priority=gobject.PRIORITY_LOW)
+
+    def __lookup(self, key):
+        pixbuf = self.pixbufs.get(key)
+        if pixbuf is None:
+            pixbuf = self.pinned.get(key)
+        return pixbuf
+
+    def __drop_scaled(self, filename):
+        for key in self.pixbufs.map.keys():
+            if key[0] == filename and key[1] == ImageCache.SCALED:
+                self.pixbufs.pop(key)
+        for key in self.pinned.keys():
+            if key[0] == filename and key[1] == ImageCache.SCALED:
+                del self.pinned[key]
+
+    def set_interpolation(self, interpolation):
+        self.interpolation = interpolation
+
+    @assert_gui_thread
+    def get(self, filename, priority=LOAD_VISIBLE):
+        """
+        Return the decoded image, or None if it's still loading.
+
+        :Raises: IOError if the image could not be loaded.
+        """
+        pixbuf = self.__lookup((filename, ImageCache.RAW))
+        if pixbuf is not None:
+            STATS.add('images.hit')
+            return pixbuf
+        pixbuf = self.warm.pop((filename, ImageCache.RAW))
+        if pixbuf is not None:
+            STATS.add('images.warm_hit')
+            self.add(filename, pixbuf)
+            return pixbuf
+        STATS.add('images.miss')
+        self.__check_failed(filename)
+        self.request(filename, priority)
+        return None
+
+    @assert_gui_thread
+    def get_size(self, filename, priority=LOAD_VISIBLE):
+        """
+        Return the full (width, height) of an image, or None if it's
+        still loading.
+
+        :Raises: IOError if the image could not be loaded.
+        """
+        size = self.index.get(filename)
+        if size == BROKEN_SIZE:
+            raise IOError("%s: cannot decode image" % filename)
+        elif size is not None:
+            return size
+        self.__check_failed(filename)
+        if filename in self.jobs:
+            return None # the size comes with the image
+        job = self.probes.get(filename)
+        if job is not None:
+            if job.priority <= priority or job.started:
+                return None
+            job.cancel()
+            del self.probes[filename]
+        if priority == LOAD_VISIBLE:
+            # the image is wanted right away, and decoding it gives the
+            # size too: don't read the file twice
+            self.request(filename, priority)
+            return None
+        self.probes[filename] = self.pool.submit(priority, self.__probe,
+                                                 filename)
+        return None
+
+    def __set_error(self, filename, error, permanent=False):
+        """Remember a failed load; not permanent ones only for a while"""
+        if permanent or isinstance(error, ImageError):
+            self.failed[filename] = (error, None)
+        else:
+            self.failed[filename] = (error, time.time() + RETRY_FAILED_DELAY)
+
+    def __get_error(self, filename):
+        """Return the error of a failed load, or None if the file has not
+        failed or it's time to try it again"""
+        entry = self.failed.get(filename)
+        if entry is None:
+            return None
+        error, retry_time = entry
+        if retry_time is not None and time.time() >= retry_time:
+            del self.failed[filename]
+            return None
+        return error
+
+    def __check_failed(self, filename):
+        error = self.__get_error(filename)
+        if error is not None:
+            if isinstance(error, IOError):
+                raise error
+            raise IOError(str(error))
+
+    @assert_gui_thread
+    def get_scaled(self, filename, width, height, rotated=False,
+                   priority=LOAD_VISIBLE):
+        key = (filename, ImageCache.SCALED, width, height, bool(rotated),
+               self.interpolation)
+        pixbuf = self.__lookup(key)
+        if pixbuf is not None:
+            return pixbuf
+
+        raw_pixbuf = self.get(filename, priority)
+        if raw_pixbuf is None:
+            return None
+        if rotated:
+            need_width, need_height = height, width
+        else:
+            need_width, need_height = width, height
+        # (a pixel of slack for rounding in the layout)
+        if ((need_width > raw_pixbuf.get_width() + 1
+             or need_height > raw_pixbuf.get_height() + 1)
+                and not self.__is_full_size(filename, raw_pixbuf)):
+            # show this one upscaled until a larger one is in: decoded to
+            # fit the screen if that is enough (eg. the window grew), at
+            # full size only if zoomed in further
+            fit_size = self.__fit_decode_size(filename)
+            full = (fit_size is None or need_width > fit_size[0] + 1
+                    or need_height > fit_size[1] + 1)
+            self.request(filename, priority, full=full)
+
+        if (priority == LOAD_VISIBLE
+                and self.interpolation != gtk.gdk.INTERP_NEAREST
+                and (need_width != raw_pixbuf.get_width()
+                     or need_height != raw_pixbuf.get_height())):
+            # show a quick preview now, and the real thing when idle
+            preview_key = key[:-1] + (gtk.gdk.INTERP_NEAREST,)
+            pixbuf = self.__lookup(preview_key)
+            if pixbuf is None:
+                pixbuf = self.__scale(raw_pixbuf, need_width, need_height,
+                                      rotated, gtk.gdk.INTERP_NEAREST)
+                self.__store(preview_key, pixbuf)
+            self.__refine_later(key)
             return pixbuf
 
+        pixbuf = self.__scale(raw_pixbuf, need_width, need_height, rotated,
+                              self.interpolation)
+        self.__store(key, pixbuf)
+        return pixbuf
+
+    def __scale(self, pixbuf, width, height, rotated, interpolation):
+        """Scale to width x height, then rotate if asked to"""
+        if width != pixbuf.get_width() or height != pixbuf.get_height():
+            pixbuf = pixbuf.scale_simple(width, height, interpolation)
+        if rotated:
+            pixbuf = pixbuf.rotate_simple(gtk.gdk.PIXBUF_ROTATE_CLOCKWISE)
+        return pixbuf
+
+    def __refine_later(self, key):
+        """Make the scaled image `key` when the GUI is idle, if its file
+        is still on screen then"""
+        if key in self.refinements:
+            return
+        self.refinements[key] = True
+        if not self.refine_pending:
+            self.refine_pending = True
+            run_in_gui_thread(self.__refine)
+
+    @assert_gui_thread
+    def __refine(self):
+        # one image per idle callback, so that input is handled in between
+        while self.refinements:
+            key = self.refinements.popitem()[0]
+            filename, kind, width, height, rotated, interpolation = key
+            if (filename not in self.pinned_files
+                    or self.__lookup(key) is not None):
+                continue
+            raw_pixbuf = self.__lookup((filename, ImageCache.RAW))
+            if raw_pixbuf is None:
+                continue
+            if rotated:
+                width, height = height, width
+            pixbuf = self.__scale(raw_pixbuf, width, height, rotated,
+                                  interpolation)
+            del raw_pixbuf
+            self.__store(key, pixbuf)
+            del pixbuf
+            preview_key = key[:-1] + (gtk.gdk.INTERP_NEAREST,)
+            self.pixbufs.pop(preview_key)
+            self.pinned.pop(preview_key, None)
+            for callback in self.loaded_callbacks:
+                callback(filename)
+            break
+        if self.refinements:
+            run_in_gui_thread(self.__refine)
+        else:
+            self.refine_pending = False
+
 class ImageView(gtk.DrawingArea):
     __gsignals__ = {
         'expose-event': 'override',
@@ -455,6 +2940,7 @@ class ImageView(gtk.DrawingArea):
     def __init__(self, cache, xspacing=0):
         self.xspacing = xspacing
         self.cache = cache
+        self.cache.loaded_callbacks.append(self.__image_loaded)
 
         self.pango_context = None
         self.pango_layout = None
@@ -485,6 +2971,7 @@ class ImageView(gtk.DrawingArea):
 
     def set_files(self, filenames):
         self.filenames = filenames
+        run_in_gui_thread(self.cache.pin, filenames)
         run_in_gui_thread(self.queue_resize)
 
     @assert_gui_thread
@@ -523,6 +3010,8 @@ class ImageView(gtk.DrawingArea):
         self.normalize_offset()
         to_show = self.__get_files_to_show(self.filenames, width, height)
         for xpos, ypos, pixbuf in to_show:
+            if pixbuf is None:
+                continue # still loading
             area = event.area.copy()
             dy = max(text_size[1] - area.y, 0)
             area.y += dy
@@ -534,7 +3023,7 @@ class ImageView(gtk.DrawingArea):
         return False
     
     @assert_gui_thread
-    def preload(self, filenames):
+    def preload(self, filenames, priority=LOAD_SPECULATIVE):
         if not DO_PRELOADING:
             return
         
@@ -546,7 +3035,12 @@ class ImageView(gtk.DrawingArea):
         x, y, width, height = self.get_allocation()
         text_size = self.__get_text_size_and_prepare_layout()
         height -= text_size[1]
-        self.__get_files_to_show(filenames, width, height)
+        self.__get_files_to_show(filenames, width, height, priority)
+
+    @assert_gui_thread
+    def __image_loaded(self, filename):
+        if filename in self.filenames:
+            self.queue_draw()
 
     @assert_gui_thread
     def __get_text_size_and_prepare_layout(self):
@@ -559,7 +3053,8 @@ class ImageView(gtk.DrawingArea):
         return text_size
 
     @assert_gui_thread
-    def __get_files_to_show(self, files, win_width, win_height):
+    def __get_files_to_show(self, files, win_width, win_height,
+                            priority=LOAD_VISIBLE):
         xpos = []
         ypos = []
         pixbufs = []
@@ -567,18 +3062,32 @@ class ImageView(gtk.DrawingArea):
         total_width = 0
         total_height = 0
 
+        # decode only as much as fits on the screen
+        if self.rotated:
+            self.cache.set_fit_size(win_height, win_width)
+        else:
+            self.cache.set_fit_size(win_width, win_height)
+
+        # the layout needs the sizes of all images: wait until they're in
+        sizes = []
+        loading = False
         i = 0
         while i < len(files):
             try:
-                raw_pixbuf = self.cache.get(files[i])
+                size = self.cache.get_size(files[i], priority)
             except IOError:
                 del files[i]
                 continue
-            total_width += raw_pixbuf.get_width()
-            total_height = max(raw_pixbuf.get_height(), total_height)
+            if size is None:
+                loading = True
+                i += 1
+                continue
+            sizes.append(size)
+            total_width += size[0]
+            total_height = max(size[1], total_height)
             i += 1
 
-        if len(files) == 0:
+        if len(files) == 0 or loading:
             return []
         
         # FIXME: separate layout rotation from image rotation?
@@ -593,15 +3102,14 @@ class ImageView(gtk.DrawingArea):
         ratio *= self.zoom_ratio
 
         for i in range(len(files)):
-            raw_pixbuf = self.cache.get(files[i])
-            img_width = int(raw_pixbuf.get_width() * ratio)
-            img_height = int(raw_pixbuf.get_height() * ratio)
+            img_width = int(sizes[i][0] * ratio)
+            img_height = int(sizes[i][1] * ratio)
 
             if self.rotated:
                 img_width, img_height = img_height, img_width
 
             pixbuf = self.cache.get_scaled(files[i], img_width, img_height,
-                                           self.rotated)
+                                           self.rotated, priority)
 
             # FIXME: separate layout rotation from image rotation?
             if not self.rotated:
@@ -668,11 +3176,13 @@ class ImageView(gtk.DrawingArea):
 
 class CollectionUI(ImageView):
     
-    def __init__(self, sources, filelist, ncolumns=1, rtl=False):
+    def __init__(self, sources, filelist, ncolumns=1, rtl=False,
+                 full_size=False, disk_cache=True):
         self.sources = sources
         self.filelist = filelist
         
-        self.cache = ImageCache(filelist)
+        self.cache = ImageCache(filelist, reduced=not full_size,
+                                disk_cache=disk_cache)
         ImageView.__init__(self, self.cache)
         
         self.pos = 0
@@ -680,6 +3190,24 @@ class CollectionUI(ImageView):
         self.ncolumns = ncolumns
         self.preload_id = 0
         self.update_id = 0
+        self.show_files = []
+        self.bookmarks = None
+        self.files_added_pending = False
+
+        # reading direction and seconds per page turn
+        self.direction = 1
+        self.turn_interval = None
+        self.last_pos = 0
+        self.last_turn = time.time()
+
+        # jump targets to keep warm, chosen around jump_anchor
+        self.jump_files = []
+        self.jump_anchor = None
+
+        self.prefetch_queue = Queue.Queue()
+        prefetcher = threading.Thread(target=self.__prefetch_worker)
+        prefetcher.setDaemon(True)
+        prefetcher.start()
 
         self.connect("map-event", self.__map_event)
 
@@ -805,6 +3333,26 @@ class CollectionUI(ImageView):
         self.__limit_position()
         self.__schedule_update_position()
 
+    def files_added(self):
+        """Note that the file list has grown. Can be called from any
+        thread; the view is updated a bit later."""
+        if self.files_added_pending:
+            return
+        self.files_added_pending = True
+        run_later_in_gui_thread(250, self.__files_added)
+
+    def __files_added(self):
+        """Refresh the caption for the new length, and the shown files
+        only if they change: this is not a move, so the queued loads
+        and preloads are left alone."""
+        self.files_added_pending = False
+        self.__limit_position()
+        if self.__get_show_files() != self.show_files:
+            self.__schedule_update_position()
+            return
+        self.__update_caption(self.show_files)
+        self.queue_draw()
+
     def set_interpolation(self, interpolation):
         self.cache.set_interpolation(interpolation)
 
@@ -826,38 +3374,88 @@ class CollectionUI(ImageView):
     def preload(self, files, preload_id=0):
         if preload_id != self.preload_id:
             return # expired preload request
-        preload_files = self.__get_preload_files()
-        for i in range(0, len(preload_files), self.ncolumns):
-            j = i + self.ncolumns
-            if j >= len(preload_files):
-                preload_files += [preload_files[-1]] * self.ncolumns
-            ImageView.preload(self, preload_files[i:j])
-
-    def schedule_preload(self, delay=750):
+        for priority, screen in self.__get_preload_screens():
+            ImageView.preload(self, screen, priority)
+
+    def schedule_preload(self, delay=None):
+        """Preload the screens the reader is heading to. By default, the
+        faster pages are turned, the sooner preloading starts."""
+        if delay is None:
+            if self.turn_interval is None:
+                delay = 750
+            else:
+                delay = int(min(max(250*self.turn_interval, 10), 750))
         self.preload_id += 1
+        preload_files = self.__get_preload_files()
+        self.prefetch_queue.put(self.__get_prefetch_files(preload_files))
         run_later_in_gui_thread(delay,
                                 self.preload,
-                                self.__get_preload_files(),
+                                preload_files,
                                 self.preload_id)
 
+    def __track_turn(self):
+        """Update the direction and rate of page turns"""
+        now = time.time()
+        step = self.pos - self.last_pos
+        if step == 0:
+            return
+        if abs(step) <= 2*self.ncolumns:
+            self.direction = cmp(step, 0)
+            interval = min(now - self.last_turn, 30.0)
+            if self.turn_interval is None:
+                self.turn_interval = interval
+            else:
+                self.turn_interval = .5*self.turn_interval + .5*interval
+        else:
+            self.turn_interval = None # a jump: start over
+        self.last_pos = self.pos
+        self.last_turn = now
+
+    def __prefetch_worker(self):
+        """Extract upcoming archive members in the background"""
+        while True:
+            files = self.prefetch_queue.get()
+            try:
+                while True:
+                    files = self.prefetch_queue.get_nowait() # skip stale
+            except Queue.Empty:
+                pass
+            try:
+                self.filelist.prefetch(files)
+            except:
+                traceback.print_exc()
+
     def __update_position(self, update_id):
         if update_id != self.update_id: return
         
         files = self.__get_show_files()
+        self.show_files = list(files)
+        self.__update_caption(files)
+        self.set_files(files)
+
+        self.schedule_preload()
+
+    def __update_caption(self, files):
         filenames = [ f for f in files ]
         filenames = [ os.path.join(os.path.basename(os.path.dirname(f)),
                                    os.path.basename(f))
                       for f in filenames ]
-        self.text = u"%d / %d: %s" % (
-            self.pos+1, len(self.filelist),
+        if self.filelist.complete:
+            more = ""
+        else:
+            more = "+"
+        self.text = u"%d / %d%s: %s" % (
+            self.pos+1, len(self.filelist), more,
             unicode(', '.join(filenames), "latin-1"))
-        self.set_files(files)
-
-        self.schedule_preload()
 
     def __schedule_update_position(self, delay=10):
+        self.__track_turn()
+        self.__schedule_loads()
         self.update_id += 1
         run_later_in_gui_thread(delay, self.__update_position, self.update_id)
+        if DO_PRELOADING and self.cache.reduced:
+            run_later_in_gui_thread(JUMP_WARM_DELAY, self.__warm_jump_files,
+                                    self.update_id)
 
     def __get_show_files(self):
         endpos = self.pos + self.ncolumns
@@ -871,17 +3469,140 @@ class CollectionUI(ImageView):
 
         return filelist
 
+    def __get_preload_screens(self):
+        """
+        Return the screens to preload as [(priority, files), ...], most
+        urgent first.
+
+        The look-ahead in the reading direction is wide enough to decode
+        the screens that will be turned to while the current ones are
+        being read, and at least one screen. The screen behind is left
+        out when reading fast.
+        """
+        n = self.ncolumns
+        screen_time = self.cache.decode_time * n / DECODE_THREADS
+        if self.turn_interval is None:
+            ahead = 2
+        else:
+            ahead = 1 + int(2 * screen_time / max(self.turn_interval, .01))
+        ahead = min(ahead, max(1, MAX_IMAGE_CACHE // n))
+
+        starts = [(LOAD_VISIBLE, self.pos),
+                  (LOAD_NEXT, self.pos + self.direction*n)]
+        if n > 1:
+            starts.append((LOAD_NEXT, self.pos + self.direction)) # 1 page
+        if self.turn_interval is None or self.turn_interval > 2*screen_time:
+            starts.append((LOAD_PREVIOUS, self.pos - self.direction*n))
+        starts += [(LOAD_SPECULATIVE, self.pos + self.direction*k*n)
+                   for k in range(2, ahead + 1)]
+
+        screens = []
+        count = 0
+        for priority, start in starts:
+            screen = [self.filelist[i]
+                      for i in range(max(start, 0),
+                                     min(start + n, len(self.filelist)))]
+            if screen and (not screens
+                           or count + len(screen) <= MAX_IMAGE_CACHE):
+                screens.append((priority, screen))
+                count += len(screen)
+        return screens
+
     def __get_preload_files(self):
         files = []
+        for priority, screen in self.__get_preload_screens():
+            for fn in screen:
+                if fn not in files:
+                    files.append(fn)
+        return files
 
-        ranges = (range(0, 2*self.ncolumns+1, 1)
-                  + range(-self.ncolumns,0,1))
-        
-        for i in ranges[:MAX_IMAGE_CACHE]:
-            if 0 <= self.pos + i < len(self.filelist):
-                files.append(self.filelist[self.pos + i])
+    def __warm_jump_files(self, update_id):
+        """
+        Choose the jump targets once the reader has stayed on the page
+        for JUMP_WARM_DELAY, and queue them. They are chosen again only
+        when the reader has moved more than 5 screens from where they
+        were chosen, so that the decodes started are not wasted.
+        """
+        if update_id != self.update_id:
+            return # turned the page meanwhile
+        n = self.ncolumns
+        if (self.jump_anchor is not None
+                and abs(self.pos - self.jump_anchor) <= 5*n):
+            return
+        self.jump_anchor = self.pos
+        self.jump_files = self.__get_jump_files(self.jump_anchor)
+        self.__schedule_loads()
+
+    def __get_jump_files(self, pos):
+        """
+        Return the pages of the screens the reader may jump to from
+        `pos`: 10 screens back and forth, the first and last screens,
+        and the bookmarks. As many as fit in WARM_CACHE_BYTES at screen
+        size, up to half of them kept for the bookmarks.
+        """
+        if not self.cache.fit_size:
+            return []
+        n = self.ncolumns
+        width, height = self.cache.fit_size
+        count = max(1, WARM_CACHE_BYTES // (3 * max(width // n, 1) * height))
+
+        def screens(starts):
+            files = []
+            for start in starts:
+                for i in range(max(start, 0),
+                               min(start + n, len(self.filelist))):
+                    fn = self.filelist[i]
+                    if fn not in files:
+                        files.append(fn)
+            return files
+        nearby = screens([pos + 10*n, pos - 10*n, 0, len(self.filelist) - n])
+        marked = []
+        if self.bookmarks is not None:
+            # slot 0 is the position the book was left at
+            marked = [fn for fn in screens(self.bookmarks.values[1:])
+                      if fn not in nearby]
+
+        reserved = min(len(marked), count // 2)
+        files = nearby[:count - reserved]
+        files += marked[:count - len(files)]
+        files += nearby[count - reserved:][:count - len(files)]
         return files
 
+    def __get_prefetch_files(self, preload_files):
+        """
+        Return the files whose data to read ahead: the ones to preload
+        first, then BYTE_PREFETCH_PAGES pages in the reading direction.
+        Only the preloaded ones are decoded; the rest just wait in the
+        member cache.
+        """
+        files = list(preload_files)
+        seen = set(files)
+        for k in range(BYTE_PREFETCH_PAGES):
+            i = self.pos + self.direction*k
+            if not 0 <= i < len(self.filelist):
+                break
+            fn = self.filelist[i]
+            if fn not in seen:
+                files.append(fn)
+                seen.add(fn)
+        return files
+
+    def __schedule_loads(self):
+        """Reorder the image loads for the new position, cancelling the
+        ones no longer needed"""
+        if self.cache.fit_size is None:
+            return # not shown yet
+        plan = []
+        for priority, screen in self.__get_preload_screens():
+            if priority == LOAD_VISIBLE or DO_PRELOADING:
+                plan += [(priority, fn) for fn in screen]
+        if DO_PRELOADING and self.cache.reduced:
+            # chosen when the reader is idle; see __warm_jump_files
+            planned = set([fn for priority, fn in plan])
+            plan += [(LOAD_JUMP, fn) for fn in self.jump_files
+                     if fn not in planned]
+        self.cache.reschedule(plan)
+
 class Config(dict):
     def load(self, filename):
         f = open(filename, "r")
@@ -929,11 +3650,14 @@ class Bookmarks(object):
 
 class PaiUI(object):
 
-    def __init__(self, sources, filelist, config, rtl=False, ncolumns=2):
+    def __init__(self, sources, filelist, config, rtl=False, ncolumns=2,
+                 full_size=False, disk_cache=True):
         self.config = config
         self.collection = CollectionUI(sources, filelist, ncolumns=ncolumns,
-                                       rtl=rtl)
+                                       rtl=rtl, full_size=full_size,
+                                       disk_cache=disk_cache)
         self.bookmarks = Bookmarks(self.collection.sources, self.config)
+        self.collection.bookmarks = self.bookmarks
         self.collection.goto(self.bookmarks[0])
 
         self.fullscreen = False
@@ -1133,7 +3857,11 @@ class PaiUI(object):
 
     @assert_gui_thread
     def close(self):
+        self.collection.filelist.cancel()
         self.bookmarks[0] = self.collection.pos
+        self.collection.cache.index.save()
+        if self.collection.cache.renditions is not None:
+            self.collection.cache.renditions.save()
         gtk.main_quit()
 
     @assert_gui_thread
@@ -1228,19 +3956,37 @@ def start(args, options, config):
     sources = [os.path.realpath(p) for p in args if os.path.exists(p)]
     
     progress = ProgressDialog("Starting PAI...")
-    def _load():
-        filelist = FileList(sources, IMAGE_EXTENSIONS, progress.queue)
-        run_in_gui_thread(_finished, filelist)
-    
+    filelist = FileList(sources, IMAGE_EXTENSIONS, progress.queue, scan=False)
+    filelist.readahead = options.readahead
+
+    # Show the viewer as soon as the first screen is known, and let the
+    # file list grow in the background
+    first_screen = Bookmarks(sources, config)[0] + options.ncolumns
+    shown = [False]
+
+    def _files_added():
+        if shown[0]:
+            if MAIN_UI is not None:
+                MAIN_UI.collection.files_added()
+        elif filelist.complete or len(filelist) >= first_screen:
+            shown[0] = True
+            filelist.progress_queue = None
+            run_in_gui_thread(_show)
+
     @assert_gui_thread
-    def _finished(filelist):
+    def _show():
         global MAIN_UI
         progress.close()
         MAIN_UI = PaiUI(sources, filelist, config, ncolumns=options.ncolumns,
-                        rtl=options.rtl)
+                        rtl=options.rtl, full_size=options.full_size,
+                        disk_cache=options.disk_cache)
         MAIN_UI.show()
+        MAIN_UI.collection.files_added()
 
-    threading.Thread(target=_load).start()
+    # (not to be waited for at exit)
+    scanner = threading.Thread(target=filelist.scan, args=(_files_added,))
+    scanner.setDaemon(True)
+    scanner.start()
 
 def main():
     usage = ("%%prog [options] [images-or-something]...\n"
@@ -1252,6 +3998,18 @@ def main():
                       help="show images in left-to-right order")
     parser.add_option("-c", "--columns", type="int", dest="ncolumns",
                       help="show images in N columns", default=DEFAULT_COLUMNS)
+    parser.add_option("-f", "--full-size", action="store_true",
+                      dest="full_size", default=False,
+                      help="always decode images at full resolution")
+    parser.add_option("-s", "--stats", action="store_true", dest="stats",
+                      default=False,
+                      help="print cache statistics on exit")
+    parser.add_option("--no-readahead", action="store_false",
+                      dest="readahead", default=READAHEAD_HINTS,
+                      help="don't give the kernel readahead hints")
+    parser.add_option("-n", "--no-disk-cache", action="store_false",
+                      dest="disk_cache", default=True,
+                      help="don't cache screen-sized images in ~/.pai")
     options, args = parser.parse_args()
 
     if options.ncolumns > 4 or options.ncolumns < 1:
@@ -1271,6 +4029,9 @@ def main():
     
     config.save(config_fn)
 
+    if options.stats:
+        STATS.report()
+
     sys.exit(0)
 
 if __name__ == "__main__": main()